@@ -0,0 +1,259 @@
+r"""
+Conversion of figures for figure_divs.py.
+
+LaTeX cannot include SVG files without shelling out to Inkscape on every
+compile. Instead, the filter converts them to PDF with cairosvg into an
+asset directory and points \includegraphics there. In draft mode, raster
+images are replaced by downsampled proxies (made with Pillow) in the
+same way, which speeds up compiles and keeps review PDFs small.
+Generated files are named by a hash of the source's content (and the
+proxy resolution), so unchanged figures are never converted again; all
+conversions of a run happen in finalize(), in a pool of worker processes
+(see `conversion-workers`).
+
+Usage:
+
+- SVG conversion is on by default and needs cairosvg (a missing
+  cairosvg is reported once). Disable it with `svg-conversion: false`.
+- Draft proxies need Pillow and are enabled with
+    ```yaml
+    draft: true
+    draft-dpi: 72
+    ```
+  The proxy of a figure is sized for its width (as a fraction of a
+  6.5in text width) at draft-dpi, 72 by default.
+- A figure that fails to convert is reported and included from its
+  original file.
+- Generated files go to .panflutist/assets (relative to the working
+  directory) unless `asset-dir` says otherwise.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import os
+import panflute as pf
+
+DEFAULT_DIRECTORY = os.path.join('.panflutist', 'assets')
+DEFAULT_DPI = 72
+
+# proxies are sized for this text width (in inches) times the figure width
+TEXTWIDTH = 6.5
+
+RASTER_EXTENSIONS = ['.png', '.jpg', '.jpeg']
+
+# conversions only run in worker processes from this many on
+MIN_PARALLEL = 2
+
+
+def available(module):
+    try:
+        __import__(module)
+    except ImportError:
+        return False
+    return True
+
+
+def extension(path):
+    return os.path.splitext(path)[1].lower()
+
+
+def convert_svg(source, temporary, options):
+    import cairosvg
+
+    cairosvg.svg2pdf(url=source, write_to=temporary)
+
+
+def make_proxy(source, temporary, options):
+    from PIL import Image
+
+    with Image.open(source) as image:
+        (width, height) = image.size
+        pixels = options['pixels']
+        if width > pixels:
+            image = image.resize(
+                (pixels, max(1, round(height * pixels / width))),
+                Image.LANCZOS)
+        if options['format'] == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        image.save(temporary,
+                   format=options['format'],
+                   dpi=(options['dpi'], options['dpi']))
+
+
+CONVERTERS = {'svg': convert_svg, 'proxy': make_proxy}
+
+
+def convert(job):
+    """Make one asset; runs in worker processes."""
+    (kind, source, target, options) = job
+    temporary = '{}.{}.tmp'.format(target, os.getpid())
+    try:
+        CONVERTERS[kind](source, temporary, options)
+        os.replace(temporary, target)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    return target
+
+
+def content_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class AssetBatch(object):
+    """Figures referenced during the walk, converted on resolve()."""
+
+    __slots__ = [
+        'directory', 'svg', 'dpi', 'cache', 'workers', 'digests', 'pending',
+        'failed'
+    ]
+
+    def __init__(self, directory, svg, dpi, cache=None, workers=1):
+        self.directory = directory
+        self.svg = svg
+        self.dpi = dpi
+        self.cache = cache
+        self.workers = max(1, workers)
+        self.digests = {}
+        self.pending = {}
+        # include path of failed conversions -> path of their source
+        self.failed = {}
+
+    def digest(self, path):
+        if path in self.digests:
+            return self.digests[path]
+
+        info = os.stat(path)
+        key = None
+        digest = None
+        if self.cache is not None:
+            # hashing the content once per version of the file is enough
+            key = self.cache.block_key([
+                'svg', os.path.abspath(path), info.st_mtime_ns, info.st_size
+            ])
+            digest = self.cache.get(key)
+        if digest is None:
+            digest = content_hash(path)
+            if key is not None:
+                self.cache.put(key, digest)
+
+        self.digests[path] = digest
+        return digest
+
+    def job(self, path, width=None):
+        """What to make for the figure at path, or None."""
+        if self.svg and extension(path) == '.svg':
+            if not available('cairosvg'):
+                pf.debug('figure conversion: cairosvg is not installed, '
+                         'including SVG files as they are')
+                self.svg = False
+                return None
+            target = self.digest(path) + '.pdf'
+            return ('svg', path, os.path.join(self.directory, target), {})
+        if self.dpi and extension(path) in RASTER_EXTENSIONS:
+            pixels = round(self.dpi * TEXTWIDTH * float(width or 1))
+            target = '{}-{}px{}'.format(self.digest(path), pixels,
+                                        extension(path))
+            options = {
+                'pixels': pixels,
+                'dpi': self.dpi,
+                'format': 'PNG' if extension(path) == '.png' else 'JPEG'
+            }
+            return ('proxy', path, os.path.join(self.directory,
+                                                target), options)
+        return None
+
+    def add(self, path, width=None):
+        """Path to include instead of path (whether it exists yet or not)."""
+        job = self.job(path, width)
+        if job is None:
+            return path
+        target = job[2]
+        if not os.path.exists(target):
+            self.pending[target] = job
+        return target
+
+    def resolve(self):
+        jobs = list(self.pending.values())
+        if not jobs:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        if self.workers > 1 and len(jobs) >= MIN_PARALLEL:
+            with ProcessPoolExecutor(
+                    max_workers=min(self.workers, len(jobs))) as pool:
+                futures = [pool.submit(convert, job) for job in jobs]
+                for (job, future) in zip(jobs, futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        self.fail(job, e)
+        else:
+            for job in jobs:
+                try:
+                    convert(job)
+                except Exception as e:
+                    self.fail(job, e)
+        self.pending = {}
+
+    def fail(self, job, error):
+        (kind, source, target, _) = job
+        pf.debug('figure conversion: {} failed, using the original: {}: {}'.
+                 format(source, type(error).__name__, error))
+        self.failed[target.replace(os.sep, '/')] = source
+
+    def patch(self, e, doc):
+        """Include the originals of figures that failed to convert."""
+        if isinstance(e, (pf.RawInline, pf.RawBlock)):
+            for (target, source) in self.failed.items():
+                if target in e.text:
+                    e.text = e.text.replace('{' + target + '}',
+                                            '{' + source + '}')
+
+
+def prepare(doc):
+    doc.assets = None
+    if doc.format != 'latex':
+        return
+    svg = doc.get_metadata('svg-conversion', default=True)
+    dpi = None
+    if doc.get_metadata('draft', default=False):
+        if available('PIL'):
+            dpi = int(doc.get_metadata('draft-dpi', default=DEFAULT_DPI))
+        else:
+            pf.debug('draft proxies: Pillow is not installed')
+    if not svg and not dpi:
+        return
+    workers = doc.get_metadata('conversion-workers',
+                               default=os.cpu_count() or 1)
+    doc.assets = AssetBatch(
+        doc.get_metadata('asset-dir', default=DEFAULT_DIRECTORY), svg, dpi,
+        getattr(doc, 'fragment_cache', None), int(workers))
+
+
+def finalize(doc):
+    batch = getattr(doc, 'assets', None)
+    if batch is not None:
+        batch.resolve()
+        if batch.failed:
+            doc.walk(batch.patch)
+    doc.assets = None
+
+
+def graphic(path, doc, width=None):
+    """
+    The path to include for the figure at path, shown at width (a
+    fraction of the text width). Schedules the conversion if needed.
+    """
+    batch = getattr(doc, 'assets', None)
+    if batch is None:
+        return path
+    try:
+        return batch.add(path, width).replace(os.sep, '/')
+    except OSError as e:
+        pf.debug('figure conversion:', e)
+        return path
@@ -0,0 +1,98 @@
+"""
+Reading and writing pandoc's JSON AST.
+
+pf.load and pf.dump wrap stdin/stdout in text streams and serialize
+with the json module. Here, documents are read from and written to the
+binary streams in one piece. Writing uses orjson if it is installed,
+which serializes a large AST several times faster. Reading always uses
+json with panflute's object hook: building the elements dominates
+loading, and the hook runs inside the C decoder, whereas orjson would
+need a second pass over the decoded data in Python. The garbage
+collector is paused meanwhile; otherwise it repeatedly scans the
+hundreds of thousands of elements created (or serialized) at once.
+
+Usage:
+
+- Used by runner.run_filter (and so by every filter's main()), the
+  daemon and build.py.
+- pip install orjson for the fast writer. Set PANFLUTIST_JSON=json to
+  use the json module anyway.
+- python benchmark.py --io compares the backends on the generated
+  document.
+"""
+
+import contextlib
+import gc
+import json
+import os
+import sys
+import panflute as pf
+from panflute.elements import from_json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKENDS = ['json', 'orjson'] if orjson is not None else ['json']
+
+
+def default_backend():
+    if os.environ.get('PANFLUTIST_JSON') == 'json':
+        return 'json'
+    return BACKENDS[-1]
+
+
+@contextlib.contextmanager
+def paused_gc():
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def loads(data, format=None):
+    """Document from JSON (bytes or str), like pf.load."""
+    with paused_gc():
+        doc = json.loads(data, object_hook=from_json)
+    if not isinstance(doc, pf.Doc):
+        raise ValueError(
+            'ast_io.loads needs the JSON of a whole pandoc document, '
+            'got {}'.format(type(doc).__name__))
+    if format is None:
+        format = sys.argv[1] if len(sys.argv) > 1 else 'html'
+    doc.format = format
+    return doc
+
+
+def dumps(doc, backend=None):
+    """UTF-8 encoded JSON of doc, like pf.dump."""
+    if not isinstance(doc, pf.Doc):
+        raise TypeError('ast_io.dumps needs a panflute.Doc, not {}'.format(
+            type(doc).__name__))
+    with paused_gc():
+        data = doc.to_json()
+        if (backend or default_backend()) == 'orjson':
+            return orjson.dumps(data)
+        return json.dumps(data,
+                          check_circular=False,
+                          separators=(',', ':'),
+                          ensure_ascii=False).encode('utf-8')
+
+
+def load(stream=None, format=None):
+    """Document from a binary stream, by default stdin."""
+    if stream is None:
+        stream = sys.stdin.buffer
+    return loads(stream.read(), format)
+
+
+def dump(doc, stream=None, backend=None):
+    """Write doc to a binary stream, by default stdout."""
+    if stream is None:
+        stream = sys.stdout.buffer
+    stream.write(dumps(doc, backend))
+    stream.flush()
@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+"""
+Benchmark the filters on synthetic, thesis-scale documents.
+
+A seeded generator writes a Markdown document with the requested number
+of figures, divtables, glossary/acronym spans, YAML code blocks and
+textquote spans, and pandoc turns it into the JSON AST once. Every filter
+then runs via its main(doc=...) in a fresh interpreter, and the wall time,
+number of pandoc subprocesses, peak RSS and time per handled element are
+reported and written to a JSON file for comparison across commits.
+pandoc calls are counted by a pandoc wrapper put first on the PATH, so
+calls from worker processes are included; the time spent in pandoc
+(pandoc_seconds) and the peak RSS are those of the filter's own process.
+
+Usage:
+
+- python benchmark.py --figures 200 --tables 50 --rows 20 --cols 4 \\
+    --glossary 5000 --listings 100 --quotes 500 --output bench.json
+- --filters selects the filters to run (default: all with matching
+  elements plus the panflutist driver), --repeat runs each one several
+  times. --deferred and --cache enable deferred conversion and the
+  conversion cache (in a temporary directory shared by the repeats, so
+  runs after the first one are warm).
+- python benchmark.py --io --glossary 20000 compares reading and
+  writing the generated AST with pf.load/pf.dump and with each
+  backend of ast_io.py (best of --repeat runs) instead of running the
+  filters.
+"""
+
+import argparse
+from functools import partial
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import ast_io
+import panflute as pf
+
+WORDS = [
+    'lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing',
+    'elit', 'sed', 'do', 'eiusmod', 'tempor', 'incididunt', 'labore',
+    'magna', 'aliqua'
+]
+
+# which generated elements each filter handles
+FILTER_ELEMENTS = {
+    'figure_divs': ['figures'],
+    'table_divs': ['tables'],
+    'glossary_spans': ['glossary'],
+    'code_divs': ['listings'],
+    'textquote': ['quotes'],
+    'panflutist':
+    ['figures', 'tables', 'glossary', 'listings', 'quotes'],
+}
+
+
+class Corpus(object):
+    """Markdown source for a synthetic document."""
+
+    __slots__ = ['options', 'random', 'parts', 'counts']
+
+    def __init__(self, options):
+        self.options = options
+        self.random = random.Random(options.seed)
+        self.parts = []
+        self.counts = {
+            'figures': options.figures,
+            'tables': options.tables,
+            'table_cells': options.tables * (options.rows + 1) * options.cols,
+            'glossary': options.glossary,
+            'listings': options.listings,
+            'quotes': options.quotes,
+        }
+
+    def words(self, n):
+        return ' '.join(self.random.choice(WORDS) for _ in range(n))
+
+    def citation(self, i):
+        return '[vgl. @Key_{}, {}]'.format(i % 97, self.random.randint(1, 400))
+
+    def metadata(self):
+        lines = ['---', 'title: Benchmark']
+        lines.append('deferred-conversion: {}'.format(
+            'true' if self.options.deferred else 'false'))
+        lines.append('conversion-cache: {}'.format(
+            'true' if self.options.cache else 'false'))
+        lines.append('---')
+        self.parts.append('\n'.join(lines))
+
+    def figure(self, i):
+        self.parts.append(
+            '![{} *{}* {}](assets/figure_{}.pdf){{#fig:{} short="{}" '
+            'placement="htbp" width="70"}}'.format(
+                self.words(6).capitalize(), self.words(1), self.citation(i),
+                i, i,
+                self.words(3).capitalize()))
+
+    def table(self, i):
+        options = self.options
+        rule = '  '.join(['-' * 14] * options.cols)
+        lines = [
+            '::: {{.divtable #tbl:{} short="{}" placement="htbp" '
+            'width="0.9"}}'.format(i, self.words(3).capitalize()),
+            '-' * len(rule),
+            '  '.join('Column {}'.format(c).ljust(14)
+                      for c in range(options.cols)), rule
+        ]
+        for r in range(options.rows):
+            cells = []
+            for c in range(options.cols):
+                if (r + c) % 3 == 0:
+                    cells.append('*{}*'.format(self.words(1))[:14].ljust(14))
+                else:
+                    cells.append('{},{}'.format(r, c).ljust(14))
+            lines.append('  '.join(cells))
+            lines.append('')
+        lines.append('-' * len(rule))
+        lines.append('Table: {} {}'.format(self.words(8).capitalize(),
+                                           self.citation(i)))
+        lines.append(':::')
+        self.parts.append('\n'.join(lines))
+
+    def glossary_span(self, i):
+        terms = max(1, self.options.glossary // 10)
+        term = i % terms
+        label = 'term{}'.format(term)
+        if term % 2:
+            if i < terms:
+                return '[{}]{{.ac short="T{}" long="{}"}}'.format(
+                    label, term, self.words(3))
+            return '[{}]{{.ac}}'.format(label)
+        if i < terms:
+            return '[{}]{{.gl name="{}" description="{} *{}*"}}'.format(
+                label, self.words(1), self.words(5).capitalize(),
+                self.words(1))
+        return '[{}]{{.gl}}'.format(label)
+
+    def quote_span(self, i):
+        return '[{}]{{.textquote cite="{}"}}'.format(
+            self.words(8).capitalize(), self.citation(i))
+
+    def listing(self, i):
+        self.parts.append('\n'.join([
+            '``` python', 'language: python',
+            'identifier: lst:{}'.format(i),
+            'caption: {} {}'.format(self.words(5).capitalize(),
+                                    self.citation(i)), '...',
+            'def function_{}(x):'.format(i),
+            '    return x * {}'.format(i), '```'
+        ]))
+
+    def paragraphs(self):
+        spans = [self.glossary_span(i) for i in range(self.options.glossary)]
+        spans += [self.quote_span(i) for i in range(self.options.quotes)]
+        for start in range(0, len(spans), 10):
+            text = []
+            for span in spans[start:start + 10]:
+                text.append(self.words(self.random.randint(3, 12)))
+                text.append(span)
+            self.parts.append(' '.join(text) + '.')
+
+    def markdown(self):
+        self.metadata()
+        self.paragraphs()
+        for i in range(self.options.figures):
+            self.figure(i)
+        for i in range(self.options.tables):
+            self.table(i)
+        for i in range(self.options.listings):
+            self.listing(i)
+        return '\n\n'.join(self.parts) + '\n'
+
+
+def pandoc_wrapper(directory):
+    """
+    A directory holding a pandoc that logs a line to $PANFLUTIST_BENCH_LOG
+    per call and runs the real one, or None if there is no pandoc.
+    """
+    pandoc = shutil.which('pandoc')
+    if pandoc is None:
+        return None
+    bin_dir = os.path.join(directory, 'bin')
+    os.makedirs(bin_dir, exist_ok=True)
+    wrapper = os.path.join(bin_dir, 'pandoc')
+    with open(wrapper, 'w', encoding='utf-8') as f:
+        f.write('#!/bin/sh\necho >> "$PANFLUTIST_BENCH_LOG"\n'
+                'exec {} "$@"\n'.format(shlex.quote(pandoc)))
+    os.chmod(wrapper, 0o755)
+    return bin_dir
+
+
+def run_one(name, path, bin_dir=None):
+    """Run one filter on the JSON document at path (in a fresh process)."""
+    import importlib
+    import panflute.tools
+
+    log = None
+    if bin_dir is not None:
+        # inherited by worker processes, which count their calls there too
+        log = os.path.join(bin_dir, 'calls.log')
+        open(log, 'w').close()
+        os.environ['PANFLUTIST_BENCH_LOG'] = log
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+
+    calls = {'count': 0, 'seconds': 0.0}
+    run_pandoc = panflute.tools.run_pandoc
+
+    def counting_run_pandoc(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return run_pandoc(*args, **kwargs)
+        finally:
+            calls['count'] += 1
+            calls['seconds'] += time.perf_counter() - start
+
+    panflute.tools.run_pandoc = counting_run_pandoc
+    pf.run_pandoc = counting_run_pandoc
+
+    with open(path, encoding='utf-8') as f:
+        doc = pf.load(f)
+    doc.format = 'latex'
+
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    import_seconds = time.perf_counter() - start
+    error = None
+    try:
+        module.main(doc=doc)
+    except Exception as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+    wall = time.perf_counter() - start
+
+    if log is not None:
+        with open(log, 'rb') as f:
+            calls['count'] = f.read().count(b'\n')
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak_rss //= 1024
+    return {
+        'wall_seconds': wall,
+        'import_seconds': import_seconds,
+        'pandoc_calls': calls['count'],
+        'pandoc_seconds': calls['seconds'],
+        'peak_rss_kb': peak_rss,
+        'error': error,
+    }
+
+
+def best_time(function, repeat):
+    best = None
+    for _ in range(max(1, repeat)):
+        start = time.perf_counter()
+        result = function()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return (best, result)
+
+
+def run_io(path, repeat):
+    """Time reading and writing the JSON document at path per backend."""
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    def panflute_load():
+        return pf.load(io.TextIOWrapper(io.BytesIO(data), encoding='utf-8'))
+
+    def panflute_dump(doc):
+        with io.StringIO() as f:
+            pf.dump(doc, f)
+            return f.getvalue().encode('utf-8')
+
+    backends = [('panflute', panflute_load, panflute_dump)]
+    for name in ast_io.BACKENDS:
+        backends.append(('ast_io/' + name, lambda: ast_io.loads(data),
+                         partial(ast_io.dumps, backend=name)))
+
+    results = []
+    reference = None
+    for (name, load, dump) in backends:
+        (load_seconds, doc) = best_time(load, repeat)
+        (dump_seconds, output) = best_time(lambda: dump(doc), repeat)
+        if reference is None:
+            reference = output
+        results.append({
+            'backend': name,
+            'load_seconds': load_seconds,
+            'dump_seconds': dump_seconds,
+            'bytes': len(output),
+            'identical': output == reference,
+        })
+        print('{:<20} load {:8.3f}s dump {:8.3f}s{}'.format(
+            name, load_seconds, dump_seconds,
+            '' if output == reference else '  (output differs)'),
+              file=sys.stderr)
+    return results
+
+
+def pandoc_version():
+    try:
+        return pf.run_pandoc(args=['--version']).splitlines()[0]
+    except OSError:
+        return None
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--figures', type=int, default=100)
+    parser.add_argument('--tables', type=int, default=20)
+    parser.add_argument('--rows', type=int, default=10)
+    parser.add_argument('--cols', type=int, default=4)
+    parser.add_argument('--glossary', type=int, default=1000)
+    parser.add_argument('--listings', type=int, default=50)
+    parser.add_argument('--quotes', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--filters', nargs='+')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--deferred', action='store_true')
+    parser.add_argument('--cache', action='store_true')
+    parser.add_argument('--io',
+                        action='store_true',
+                        help='compare JSON backends instead of filters')
+    parser.add_argument('--save-corpus', metavar='PATH',
+                        help='keep the generated JSON document')
+    parser.add_argument('--output', '-o', metavar='PATH',
+                        help='write results as JSON (default: stdout)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    corpus = Corpus(options)
+    filters = options.filters or [
+        name for (name, kinds) in FILTER_ELEMENTS.items()
+        if any(corpus.counts[kind] for kind in kinds)
+    ]
+
+    with tempfile.TemporaryDirectory(prefix='panflutist-bench-') as tmp:
+        path = options.save_corpus or os.path.join(tmp, 'corpus.json')
+        start = time.perf_counter()
+        doc = pf.convert_text(corpus.markdown(), standalone=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            pf.dump(doc, f)
+        generate_seconds = time.perf_counter() - start
+
+        os.environ['PANFLUTIST_CACHE'] = os.path.join(tmp, 'cache.sqlite')
+        bin_dir = pandoc_wrapper(tmp)
+        context = multiprocessing.get_context('spawn')
+        runs = []
+        io_runs = run_io(path, options.repeat) if options.io else None
+        for name in filters if not options.io else []:
+            elements = sum(
+                corpus.counts[kind] for kind in FILTER_ELEMENTS.get(name, []))
+            for repeat in range(options.repeat):
+                with context.Pool(1) as pool:
+                    result = pool.apply(run_one, (name, path, bin_dir))
+                result.update({
+                    'filter': name,
+                    'repeat': repeat,
+                    'elements': elements,
+                    'seconds_per_element':
+                    result['wall_seconds'] / elements if elements else None,
+                })
+                runs.append(result)
+                print('{:<20} #{} {:8.3f}s {:6d} pandoc calls {:8d} kB{}'.format(
+                    name, repeat, result['wall_seconds'],
+                    result['pandoc_calls'], result['peak_rss_kb'],
+                    '  ' + result['error'] if result['error'] else ''),
+                      file=sys.stderr)
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'panflute': pf.__version__,
+        'pandoc': pandoc_version(),
+        'parameters': vars(options),
+        'elements': corpus.counts,
+        'generate_seconds': generate_seconds,
+        'runs': runs,
+    }
+    if io_runs is not None:
+        report['io'] = io_runs
+    if options.output:
+        with open(options.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+r"""
+Reuse of rendered blocks across builds.
+
+Filters that render whole elements (divtables, images, YAML code blocks,
+unnumbered headings) wrap their action with cached_action() or
+cached_fenced(). The element is fingerprinted by a hash of its JSON, the
+attributes of an enclosing Div, the output format, the metadata the
+filter depends on, the pandoc version and the source code of this
+repository (which includes all templates). If the persistent conversion
+cache (see fragment_cache.py) has a RawBlock/RawInline for the
+fingerprint, it is returned without rendering; otherwise the rendered
+result is stored once the document is finalized, with the results of
+deferred conversions substituted (also in results that are no longer
+part of the document, e.g. figures inside a converted table cell).
+
+Usage:
+
+- On whenever the conversion cache is. Disable it for a document with:
+    ```yaml
+    block-cache: false
+    ```
+"""
+
+import functools
+import glob
+import hashlib
+import json
+import os
+import conversion
+import panflute as pf
+
+_code_version = None
+
+
+def code_version():
+    """Hash of all Python sources next to this module."""
+    global _code_version
+    if _code_version is None:
+        digest = hashlib.sha256(pf.__version__.encode('utf-8'))
+        directory = os.path.dirname(os.path.abspath(__file__))
+        for path in sorted(glob.glob(os.path.join(directory, '*.py'))):
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+        _code_version = digest.hexdigest()
+    return _code_version
+
+
+def prepare(doc):
+    doc.block_pending = []
+    cache = getattr(doc, 'fragment_cache', None)
+    if cache is not None and not doc.get_metadata('block-cache',
+                                                  default=True):
+        cache = None
+    doc.block_cache = cache
+
+
+def store(doc):
+    cache = getattr(doc, 'block_cache', None)
+    if cache is not None:
+        for (key, e) in doc.block_pending:
+            # results nested in other results (e.g. a figure in a table
+            # cell) are no longer in the document, so they were not patched
+            text = conversion.resolve_text(e.text, doc)
+            if conversion.PLACEHOLDER_RE.search(text):
+                pf.debug('block cache: not storing a {} with unresolved '
+                         'conversions'.format(type(e).__name__))
+                continue
+            cache.put(key, json.dumps([type(e).__name__, e.format, text]))
+    doc.block_pending = []
+    doc.block_cache = None
+
+
+def fingerprint(cache, name, e, doc, metadata, extra=None):
+    parent = e.parent
+    context = None
+    if isinstance(parent, pf.Div):
+        context = [parent.identifier, list(parent.classes),
+                   dict(parent.attributes)]
+    return cache.block_key([
+        'block', name, code_version(), doc.format,
+        [doc.get_metadata(key) for key in metadata], context, extra,
+        e.to_json()
+    ])
+
+
+def lookup(name, e, doc, metadata, extra=None):
+    cache = getattr(doc, 'block_cache', None)
+    if cache is None:
+        return (None, None)
+    key = fingerprint(cache, name, e, doc, metadata, extra)
+    cached = cache.get(key)
+    if cached is None:
+        return (key, None)
+    (kind, format, text) = json.loads(cached)
+    if kind == 'RawBlock':
+        return (key, pf.RawBlock(text, format=format))
+    return (key, pf.RawInline(text, format=format))
+
+
+def remember(key, result, doc):
+    if key is not None and isinstance(result, (pf.RawBlock, pf.RawInline)):
+        # stored by store() once deferred conversions are patched in
+        doc.block_pending.append((key, result))
+
+
+def cached_action(name, match, metadata=(), depends=None):
+    """
+    Cache the results of an action(e, doc) for elements matching match.
+    depends(e, doc) returns what else the result depends on.
+    """
+
+    def decorator(action):
+
+        @functools.wraps(action)
+        def wrapper(e, doc, *args, **kwargs):
+            if not match(e, doc):
+                return action(e, doc, *args, **kwargs)
+            extra = None
+            if depends is not None:
+                extra = depends(e, doc)
+            (key, result) = lookup(name, e, doc, metadata, extra)
+            if result is None:
+                result = action(e, doc, *args, **kwargs)
+                remember(key, result, doc)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def cached_fenced(name, metadata=(), depends=None):
+    """
+    Cache the results of a yaml_filter function(options, data, e, doc).
+    depends(options, data, e, doc) returns what else the result depends
+    on, e.g. the timestamp of an included file.
+    """
+
+    def decorator(function):
+
+        @functools.wraps(function)
+        def wrapper(options, data, element, doc):
+            extra = None
+            if depends is not None:
+                extra = depends(options, data, element, doc)
+            (key, result) = lookup(name, element, doc, metadata, extra)
+            if result is None:
+                result = function(options, data, element, doc)
+                remember(key, result, doc)
+            return result
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+"""
+Build the chapters of a book in parallel.
+
+Every chapter is read by pandoc, run through the panflutist driver and
+written as a LaTeX fragment (for \\include in the main file). Chapters
+are spread over a pool of worker processes, which keep the filters and
+templates loaded between chapters and share the persistent conversion
+cache. Glossary and abbreviation definitions are collected from all
+chapters and merged into a single preamble include.
+
+Usage:
+
+- python build.py --jobs 8 --output-dir build chapters/*.md
+- Then \\input{build/glossary.tex} in the preamble of the main file.
+- --reader-arg/--writer-arg pass extra arguments to the reading and
+  writing pandoc runs, e.g. --reader-arg=--from=markdown+smart.
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import os
+import subprocess
+import sys
+import time
+import ast_io
+import glossary_spans
+import panflute as pf
+import panflutist
+
+
+def pandoc(args, data=None):
+    result = subprocess.run(['pandoc'] + args,
+                            input=data,
+                            stdout=subprocess.PIPE,
+                            check=True)
+    return result.stdout
+
+
+def pop_definitions(doc):
+    """(kind, label, sort text, tex) of the entries a chapter exported."""
+    definitions = doc.metadata.content.pop('glossary-definitions', None)
+    if definitions is None:
+        return []
+    entries = []
+    for value in definitions.content.values():
+        fields = value.content
+        entries.append((fields['kind'].text, fields['label'].text,
+                        fields['sort'].text,
+                        ''.join(e.text for e in fields['tex'].content)))
+    return entries
+
+
+def sort_settings(doc):
+    """Whether and in which locale a chapter sorts its glossary."""
+    if not doc.get_metadata('glossary-sort', default=False):
+        return None
+    return glossary_spans.locale_name(doc) or ''
+
+
+def build_chapter(path, output, reader_args, writer_args):
+    start = time.perf_counter()
+    source = pandoc([path, '--to=json'] + reader_args)
+
+    doc = ast_io.loads(source, format='latex')
+    doc.metadata['glossary-export'] = pf.MetaBool(True)
+    doc = panflutist.main(doc=doc)
+    definitions = pop_definitions(doc)
+    sorting = sort_settings(doc)
+
+    pandoc(['--from=json', '--to=latex', '--output=' + output] + writer_args,
+           ast_io.dumps(doc))
+    return (path, definitions, sorting, time.perf_counter() - start)
+
+
+def merge_definitions(chapters):
+    """
+    (label, sort text, tex) of all entries, in first-seen order. As in
+    glossary_spans.py, the last of conflicting definitions wins, and a
+    label keeps the kind (abbreviation or glossary entry) it was first
+    defined as.
+    """
+    merged = {}
+    kinds = {}
+    for (path, definitions, _, _) in chapters:
+        for (kind, label, text, tex) in definitions:
+            if kinds.setdefault(label, kind) != kind:
+                print('{}: {} is already {}, dropping this definition'.format(
+                    path, label, glossary_spans.KINDS[kinds[label]]),
+                      file=sys.stderr)
+                continue
+            if label in merged and merged[label][2] != tex:
+                print('{}: conflicting definitions of {}, keeping the last'.
+                      format(path, label),
+                      file=sys.stderr)
+            merged[label] = (label, text, tex)
+    return list(merged.values())
+
+
+def glossary_lines(definitions, chapters):
+    sorting = [settings for (_, _, settings, _) in chapters
+               if settings is not None]
+    if not sorting:
+        return [r'\makeglossaries'] + [tex for (_, _, tex) in definitions]
+    # entries printed with \printunsrtglossaries need no indexing
+    name = next((name for name in sorting if name), None)
+    return [
+        tex
+        for (_, _, tex) in glossary_spans.sort_definitions(definitions, name)
+    ]
+
+
+def chapter_output(path, output_dir):
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(output_dir, name + '.tex')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('chapters', nargs='+')
+    parser.add_argument('--output-dir', '-o', default='build')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count())
+    parser.add_argument('--glossary', default='glossary.tex',
+                        help='name of the merged glossary include')
+    parser.add_argument('--reader-arg', action='append', default=[])
+    parser.add_argument('--writer-arg', action='append',
+                        default=None,
+                        help='default: --biblatex')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    writer_args = options.writer_arg
+    if writer_args is None:
+        writer_args = ['--biblatex']
+    os.makedirs(options.output_dir, exist_ok=True)
+
+    outputs = [chapter_output(path, options.output_dir)
+               for path in options.chapters]
+    if len(set(outputs)) != len(outputs):
+        sys.exit('chapter file names must be unique')
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=options.jobs) as pool:
+        futures = [
+            pool.submit(build_chapter, path, output, options.reader_arg,
+                        writer_args)
+            for (path, output) in zip(options.chapters, outputs)
+        ]
+        chapters = []
+        for future in futures:
+            chapters.append(future.result())
+            print('{}: {:.2f}s'.format(chapters[-1][0], chapters[-1][3]),
+                  file=sys.stderr)
+
+    definitions = merge_definitions(chapters)
+    tex = glossary_lines(definitions, chapters)
+    with open(os.path.join(options.output_dir, options.glossary),
+              'w',
+              encoding='utf-8') as f:
+        f.write('\n'.join(tex) + '\n')
+
+    print('{} chapters, {} glossary entries in {:.2f}s'.format(
+        len(chapters), len(definitions),
+        time.perf_counter() - start),
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
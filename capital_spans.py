@@ -31,10 +31,14 @@ Usage:
   see their respective CTAN entries.
 """
 
-from jinja2tex import latex_env
+from jinja2tex import template
 import panflute as pf
+import runner
 
-UPPERCASE = latex_env.from_string(r'\textuppercase{<< text >>}')
+UPPERCASE = template(r'\textuppercase{<< text >>}')
+
+
+HANDLES = [(pf.Span, 'allcaps')]
 
 
 def action(e, doc):
@@ -45,7 +49,7 @@ def action(e, doc):
 
 
 def main(doc=None):
-    return pf.run_filter(action, doc=doc)
+    return runner.run_filter(action, doc=doc, handles=HANDLES)
 
 
 if __name__ == '__main__':
@@ -34,15 +34,25 @@ Usage:
 
 - Supported YAML options are identifier, caption and mintedopts. caption
   supports Markdown, including citations.
+- Instead of pasting the code, name a file (and optionally a range) with
+  file, lines, start-after and end-before (see excerpts.py).
+- With `code-highlighting: pygments` in the metadata, listings are
+  highlighted by the filter instead of minted (see highlighting.py), so
+  LaTeX needs no -shell-escape.
 - Tag is 'python' instead of a generic 'code' to keep syntax highlighting
   in VS Code intact. The trade-off of having to extend the filter to support
   additional languages seems worth it to me.
 """
 
-from jinja2tex import latex_env
+from jinja2tex import template
+import block_cache
+import conversion
+import excerpts
+import highlighting
 import panflute as pf
+import runner
 
-TEMPLATE_FLOATING_CODEBLOCK = latex_env.from_string(r"""\begin{listing}[htbp]
+TEMPLATE_FLOATING_CODEBLOCK = template(r"""\begin{listing}[htbp]
 \begin{minted}$mintedopts{$language}
 $text
 \end{minted}
@@ -50,7 +60,7 @@ $caption
 $identifier
 \end{listing}""")
 
-TEMPLATE_CODEBLOCK = latex_env.from_string(r"""{%
+TEMPLATE_CODEBLOCK = template(r"""{%
 \singlespacing
 \begin{minted}$mintedopts{$language}
 $text
@@ -59,12 +69,16 @@ $text
 $caption
 $identifier
 }""")
-CODEBLOCK = latex_env.from_string(r"""<%- if floating -%>
+CODEBLOCK = template(r"""<%- if floating -%>
 \begin{listing}<% if placement %>[<< placement >>]<% endif %>
 <%- endif -%>
+<% if highlighted -%>
+<< highlighted >>
+<% else -%>
 \begin{minted}<% if options %>[<< options >>]<% endif %>{<< language >>}
 << content >>
 \end{minted}
+<% endif -%>
 <% if caption %><% if floating %>\caption<% if shortcaption %>[<< shortcaption >>]<% endif %>{<< caption >>}<% else %>\captionof{listing}<% if shortcaption %>[<< shortcaption >>]<% endif %>{<< caption >>}<% endif %><% endif %>
 <% if identifier %>\label{<< identifier >>}<% endif %>
 <% if floating %>\end{listing}<% endif %>""")
@@ -72,23 +86,31 @@ CODEBLOCK = latex_env.from_string(r"""<%- if floating -%>
 
 def fenced_latex(options, data, element, doc):
     raw_caption = options.get('caption')
-    caption = pf.convert_text(options.get('caption'),
-                              extra_args=['--biblatex'],
-                              input_format='markdown',
-                              output_format='latex') if raw_caption else None
+    caption = conversion.convert_text(options.get('caption'),
+                                      doc,
+                                      extra_args=['--biblatex'],
+                                      input_format='markdown',
+                                      output_format='latex') if raw_caption else None
 
     raw_shortcaption = options.get('shortcaption')
-    shortcaption = pf.convert_text(options.get('shortcaption'),
+    shortcaption = conversion.convert_text(options.get('shortcaption'),
+                              doc,
                               extra_args=['--biblatex'],
                               input_format='markdown',
                               output_format='latex') if raw_shortcaption else None
 
+    highlighted = None
+    if doc.listings is not None:
+        highlighted = doc.listings.add(data, options.get('language'),
+                                       options.get('mintedopts'))
+
     latex = CODEBLOCK.render({
         'floating': options.get('caption'),
         'placement': options.get('placement'),
         'options': options.get('mintedopts'),
         'language': options.get('language'),
         'content': data,
+        'highlighted': highlighted,
         'caption': caption,
         'shortcaption': shortcaption,
         'identifier': options.get('identifier', '')
@@ -100,10 +122,11 @@ def fenced_html(options, data, element, doc):
     identifier = options.get('identifier', '')
     element.identifier = identifier
     caption = options.get('caption', '')
-    caption = pf.convert_text(caption,
-                              extra_args=['--biblatex'],
-                              input_format='markdown',
-                              output_format='html')
+    caption = conversion.convert_text(caption,
+                                      doc,
+                                      extra_args=['--biblatex'],
+                                      input_format='markdown',
+                                      output_format='html')
 
     caption_span = pf.Plain(
         pf.Span(pf.RawInline(caption), classes=['fencedSourceCodeCaption']))
@@ -117,22 +140,37 @@ def fenced_html(options, data, element, doc):
                   classes=['fencedSourceCode'])
 
 
+@block_cache.cached_fenced('code_divs',
+                           metadata=['code-highlighting', 'pygments-style'],
+                           depends=excerpts.depends)
 def fenced_listing(options, data, element, doc):
     # We'll only run this for CodeBlock elements of class 'python'
+    if options and options.get('file'):
+        data = excerpts.excerpt(options, doc)
     if doc.format == 'latex':
         return fenced_latex(options, data, element, doc)
     elif doc.format == 'html':
         return fenced_html(options, data, element, doc)
 
 
+TAGS = {'python': fenced_listing, 'bash': fenced_listing, 'sql': fenced_listing}
+HANDLES = [(pf.CodeBlock, tag) for tag in TAGS]
+
+
+def prepare(doc):
+    highlighting.prepare(doc)
+
+
+def finalize(doc):
+    highlighting.finalize(doc)
+
+
 def main(doc=None):
-    return pf.run_filter(pf.yaml_filter,
-                         doc=doc,
-                         tags={
-                             'python': fenced_listing,
-                             'bash': fenced_listing,
-                             'sql': fenced_listing
-                         })
+    return runner.run_filter(pf.yaml_filter,
+                             prepare=prepare,
+                             finalize=finalize,
+                             doc=doc,
+                             tags=TAGS)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,296 @@
+r"""
+Fragment conversion shared by all filters.
+
+Filters convert captions, cells, quotes and descriptions with
+convert_text() instead of calling pf.convert_text directly. By default
+every call still runs its own pandoc process. In deferred mode,
+convert_text() returns a placeholder instead; all fragments sharing the
+same input format, output format and extra_args are then converted in a
+single pandoc run and patched back into the RawInline/RawBlock output.
+Large groups are split into chunks, and all chunks are converted in
+parallel by a pool of worker threads (one per core by default); results
+are patched back by fragment, so the output does not depend on the order
+in which chunks finish.
+
+Fragments simple enough for the in-process LaTeX writer (see
+latex_writer.py) never reach pandoc. Both modes look all others up in
+the persistent conversion cache first (see fragment_cache.py) and only
+run pandoc on a miss.
+
+Usage:
+
+- Enable deferred mode in the document metadata:
+    ```yaml
+    deferred-conversion: true
+    ```
+- Limit the number of concurrent pandoc processes with
+  `conversion-workers: 4`.
+- Run filters through runner.run_filter, which calls prepare() and
+  finalize() around the filter's own hooks.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import re
+import time
+import fragment_cache
+import latex_writer
+import panflute as pf
+
+PLACEHOLDER = 'PANFLUTISTFRAGMENT{:08d}Z'
+PLACEHOLDER_RE = re.compile(r'PANFLUTISTFRAGMENT(\d{8})Z')
+SEPARATOR = 'PANFLUTISTSEPARATOR'
+SEPARATOR_RE = re.compile(r'\n*^' + SEPARATOR + r'$\n*', flags=re.MULTILINE)
+
+# groups are only split up into chunks of at least this many fragments;
+# below that, another pandoc start costs more than it saves
+MIN_CHUNK = 16
+
+
+def _as_blocks(text):
+    if isinstance(text, pf.Element):
+        return [text]
+    return list(text)
+
+
+def _wrap(text, input_format, doc):
+    # pf.convert_text spends an extra pandoc run on querying the API
+    # version when it gets bare elements; the document already knows it.
+    if input_format == 'panflute' and not isinstance(text, pf.Doc):
+        api_version = getattr(doc, 'api_version', None)
+        if api_version is not None:
+            return pf.Doc(*_as_blocks(text), api_version=api_version)
+    return text
+
+
+def _convert(text, input_format, output_format, extra_args, doc=None):
+    return pf.convert_text(_wrap(text, input_format, doc),
+                           extra_args=list(extra_args),
+                           input_format=input_format,
+                           output_format=output_format)
+
+
+class FragmentBatch(object):
+    """Fragments registered during the walk, converted on resolve()."""
+
+    __slots__ = ['doc', 'cache', 'workers', 'pending', 'results']
+
+    def __init__(self, doc, cache=None, workers=1):
+        self.doc = doc
+        self.cache = cache
+        self.workers = max(1, workers)
+        self.pending = {}
+        self.results = []
+
+    def add(self, text, input_format, output_format, extra_args):
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.key(text, input_format, output_format,
+                                       extra_args)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        index = len(self.results)
+        self.results.append(None)
+        key = (input_format, output_format, tuple(extra_args))
+        self.pending.setdefault(key, []).append((index, text, cache_key))
+        return PLACEHOLDER.format(index)
+
+    def _convert_group(self, key, fragments):
+        input_format, output_format, extra_args = key
+        if len(fragments) == 1:
+            return [
+                _convert(fragments[0][1], input_format, output_format,
+                         extra_args, self.doc)
+            ]
+
+        if input_format == 'panflute':
+            blocks = []
+            for (i, (_, text, _)) in enumerate(fragments):
+                if i:
+                    blocks.append(pf.RawBlock(SEPARATOR, format=output_format))
+                blocks.extend(_as_blocks(text))
+            source = blocks
+        else:
+            separator = '\n\n```{{={}}}\n{}\n```\n\n'.format(
+                output_format, SEPARATOR)
+            source = separator.join(text for (_, text, _) in fragments)
+
+        converted = _convert(source, input_format, output_format, extra_args,
+                             self.doc)
+        parts = SEPARATOR_RE.split(converted)
+        if len(parts) != len(fragments):
+            # a fragment swallowed a separator, e.g. through an unclosed
+            # fence; convert this group one by one instead
+            pf.debug('deferred conversion: falling back for', len(fragments),
+                     'fragments')
+            parts = [
+                _convert(text, input_format, output_format, extra_args,
+                         self.doc) for (_, text, _) in fragments
+            ]
+        return parts
+
+    def chunks(self, fragments):
+        size = max(MIN_CHUNK, -(-len(fragments) // self.workers))
+        return [
+            fragments[i:i + size] for i in range(0, len(fragments), size)
+        ]
+
+    def resolve(self):
+        jobs = [(key, chunk)
+                for (key, fragments) in self.pending.items()
+                for chunk in self.chunks(fragments)]
+        if self.workers > 1 and len(jobs) > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                futures = [
+                    pool.submit(self._convert_group, key, chunk)
+                    for (key, chunk) in jobs
+                ]
+                converted = [future.result() for future in futures]
+        else:
+            converted = [self._convert_group(key, chunk) for (key, chunk) in jobs]
+
+        # the cache is only used from this thread
+        for ((_, chunk), parts) in zip(jobs, converted):
+            for ((index, _, cache_key), part) in zip(chunk, parts):
+                self.results[index] = part
+                if cache_key is not None:
+                    self.cache.put(cache_key, part)
+        self.pending = {}
+
+    def substitute(self, text):
+        # converted fragments may contain placeholders of fragments that
+        # were nested inside them
+        return PLACEHOLDER_RE.sub(
+            lambda m: self.substitute(self.results[int(m.group(1))]), text)
+
+    def patch(self, e, doc):
+        if isinstance(e, (pf.RawInline, pf.RawBlock)):
+            if PLACEHOLDER_RE.search(e.text):
+                e.text = self.substitute(e.text)
+
+
+def _convert_text(text, doc, input_format, output_format, extra_args):
+    # returns the converted text and how it was obtained
+    if output_format == 'latex':
+        converted = latex_writer.write(text, input_format, extra_args)
+        if converted is not None:
+            return (converted, 'native')
+
+    batch = getattr(doc, 'fragments', None)
+    if batch is not None:
+        return (batch.add(text, input_format, output_format,
+                          extra_args), 'deferred')
+
+    cache = getattr(doc, 'fragment_cache', None)
+    if cache is None:
+        return (_convert(text, input_format, output_format, extra_args,
+                         doc), 'pandoc')
+
+    key = cache.key(text, input_format, output_format, extra_args)
+    converted = cache.get(key)
+    if converted is not None:
+        return (converted, 'cached')
+    converted = _convert(text, input_format, output_format, extra_args, doc)
+    cache.put(key, converted)
+    return (converted, 'pandoc')
+
+
+def convert_text(text,
+                 doc,
+                 input_format='markdown',
+                 output_format='latex',
+                 extra_args=None):
+    """
+    Drop-in for pf.convert_text returning a string. In deferred mode the
+    string is a placeholder that is only valid inside RawInline/RawBlock
+    output.
+    """
+    extra_args = extra_args or []
+    profiler = getattr(doc, 'profiler', None)
+    if profiler is None:
+        return _convert_text(text, doc, input_format, output_format,
+                             extra_args)[0]
+
+    start = time.perf_counter()
+    (converted, route) = _convert_text(text, doc, input_format,
+                                       output_format, extra_args)
+    # element and classes do not apply; the formats go with the route
+    kind = '{} {}->{}'.format(route, input_format, output_format)
+    profiler.record(('conversion', kind, '', ''), time.perf_counter() - start)
+    return converted
+
+
+def convert_many(texts,
+                 doc=None,
+                 input_format='markdown',
+                 output_format='latex',
+                 extra_args=None,
+                 workers=None):
+    """
+    Convert a list of fragments right away, in as few pandoc runs as
+    possible (e.g. all glossary descriptions in finalize()). Returns the
+    converted strings in order.
+    """
+    extra_args = extra_args or []
+    if workers is None:
+        workers = os.cpu_count() or 1
+        if doc is not None:
+            workers = doc.get_metadata('conversion-workers', default=workers)
+    batch = FragmentBatch(doc, getattr(doc, 'fragment_cache', None),
+                          int(workers))
+
+    converted = []
+    for text in texts:
+        tex = None
+        if output_format == 'latex':
+            tex = latex_writer.write(text, input_format, extra_args)
+        if tex is None:
+            tex = batch.add(text, input_format, output_format, extra_args)
+        converted.append(tex)
+    batch.resolve()
+    return [batch.substitute(tex) for tex in converted]
+
+
+def prepare(doc):
+    doc.fragment_cache = fragment_cache.open_cache(doc)
+    if doc.get_metadata('deferred-conversion', default=False):
+        workers = doc.get_metadata('conversion-workers',
+                                   default=os.cpu_count() or 1)
+        doc.fragments = FragmentBatch(doc, doc.fragment_cache, int(workers))
+    else:
+        doc.fragments = None
+
+
+def resolve_text(text, doc):
+    """
+    text with the placeholders of deferred conversions replaced, for
+    output that is written before the document is finalized (e.g. side
+    files). Converts all pending fragments right away if needed.
+    """
+    batch = getattr(doc, 'fragments', None)
+    if batch is None or not PLACEHOLDER_RE.search(text):
+        return text
+    batch.resolve()
+    return batch.substitute(text)
+
+
+def resolve(doc):
+    # the batch is kept until close(): results that are no longer in the
+    # document (see block_cache.store) are resolved with resolve_text()
+    batch = getattr(doc, 'fragments', None)
+    if batch is not None:
+        batch.resolve()
+        doc.walk(batch.patch)
+
+
+def close(doc):
+    doc.fragments = None
+    fragment_cache.close_cache(doc, getattr(doc, 'fragment_cache', None))
+    doc.fragment_cache = None
+
+
+def finalize(doc):
+    resolve(doc)
+    close(doc)
@@ -0,0 +1,136 @@
+r"""
+Excerpts of source files for code_divs.py.
+
+A listing can name a file instead of embedding its body. The file is
+memory-mapped and only scanned up to the requested range, so a short
+excerpt of a large generated file neither loads the whole file nor
+ends up in the Markdown AST. Excerpts are kept in the persistent
+conversion cache, keyed by path, modification time, size and range.
+
+Usage:
+
+- In a YAML code block:
+    ``` python
+    language: python
+    file: src/model.py
+    start-after: "# begin training"
+    end-before: "# end training"
+    lines: 1-10, 15-
+    ...
+    ```
+- start-after/end-before narrow the excerpt to the lines after the
+  first line containing the start marker and before the next line
+  containing the end marker. lines then selects 1-based line ranges
+  within that excerpt (or the whole file). A marker that is not found
+  is reported and ignored, so the excerpt starts at the beginning or
+  ends at the end of the file instead.
+"""
+
+import mmap
+import os
+import panflute as pf
+
+
+def parse_lines(spec):
+    """'3, 5-7, 10-' -> [(3, 3), (5, 7), (10, None)]"""
+    ranges = []
+    for part in str(spec).split(','):
+        part = part.strip()
+        if not part:
+            continue
+        (first, dash, last) = part.partition('-')
+        first = int(first) if first.strip() else 1
+        if not dash:
+            last = first
+        else:
+            last = int(last) if last.strip() else None
+        ranges.append((first, last))
+    return ranges
+
+
+def skip_lines(m, position, end, count):
+    """Offset after count more lines from position (at most end)."""
+    for _ in range(count):
+        newline = m.find(b'\n', position, end)
+        if newline < 0:
+            return end
+        position = newline + 1
+    return position
+
+
+def read_range(m, start, end, first, last):
+    start = skip_lines(m, start, end, first - 1)
+    if last is not None:
+        end = skip_lines(m, start, end, last - first + 1)
+    return m[start:end]
+
+
+def read_excerpt(path, lines=None, start_after=None, end_before=None):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ''
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            (start, end) = (0, len(m))
+            if start_after:
+                found = m.find(start_after.encode('utf-8'))
+                if found < 0:
+                    pf.debug('excerpt: {}: start-after marker {!r} not found'.
+                             format(path, start_after))
+                else:
+                    start = skip_lines(m, found, end, 1)
+            if end_before:
+                found = m.find(end_before.encode('utf-8'), start)
+                if found < 0:
+                    pf.debug('excerpt: {}: end-before marker {!r} not found'.
+                             format(path, end_before))
+                else:
+                    end = m.rfind(b'\n', start, found) + 1 or start
+
+            if lines:
+                parts = [
+                    read_range(m, start, end, first, last).rstrip(b'\n')
+                    for (first, last) in parse_lines(lines)
+                ]
+                data = b'\n'.join(parts)
+            else:
+                data = m[start:end]
+    return data.decode('utf-8', errors='replace').rstrip('\n')
+
+
+def stamp(path):
+    """What an excerpt of path depends on besides the range."""
+    info = os.stat(path)
+    return [os.path.abspath(path), info.st_mtime_ns, info.st_size]
+
+
+def excerpt(options, doc):
+    """The listing body selected by the file options of a code block."""
+    path = options['file']
+    selection = [
+        options.get('lines'),
+        options.get('start-after'),
+        options.get('end-before')
+    ]
+    cache = getattr(doc, 'fragment_cache', None)
+    if cache is None:
+        return read_excerpt(path, *selection)
+
+    key = cache.block_key(['excerpt'] + stamp(path) +
+                          [str(value) for value in selection])
+    data = cache.get(key)
+    if data is None:
+        data = read_excerpt(path, *selection)
+        cache.put(key, data)
+    return data
+
+
+def depends(options, data, element, doc):
+    """Extra fingerprint for the block cache of listings with a file."""
+    path = options.get('file') if isinstance(options, dict) else None
+    if not path:
+        return None
+    try:
+        return stamp(path)
+    except OSError as e:
+        pf.debug('excerpt:', e)
+        return None
@@ -9,14 +9,21 @@ Usage:
     ```markdown
     ![Erträge von Food-Trucks [vgl. @Perez_PythonEcosystem_2011, 13]](../assets/ex1_food_truck_profit.pdf){.ext #ref_a_figure short="This is a short figure caption" placement="htbp" width="0.7"}
     ```
+- SVG figures are converted to PDF by the filter if cairosvg is
+  installed, and with `draft: true` raster figures are replaced by
+  low-resolution proxies (see assets.py).
 
 """
 
 from enum import Enum
-from jinja2tex import latex_env
+from jinja2tex import template
+import assets
+import block_cache
+import conversion
 import panflute as pf
+import runner
 
-LATEX_INCLUDEGRAPHICS = USE_TERM = latex_env.from_string(
+LATEX_INCLUDEGRAPHICS = USE_TERM = template(
     r"""\begin{figure}<% if placement %>[<< placement >>]<% endif %>
 <% if identifier %>\hypertarget{<< identifier >>}{%<% endif %>
 \centering
@@ -25,7 +32,7 @@ LATEX_INCLUDEGRAPHICS = USE_TERM = latex_env.from_string(
 <% if identifier %>}<% endif %>
 \end{figure}""")
 
-LATEX_INPUT = USE_TERM = latex_env.from_string(
+LATEX_INPUT = USE_TERM = template(
     r"""\begin{figure}<% if placement %>[<< placement >>]<% endif %>
 <% if identifier %>\hypertarget{<< identifier >>}{%<% endif %>
 \centering
@@ -35,34 +42,42 @@ LATEX_INPUT = USE_TERM = latex_env.from_string(
 \end{figure}""")
 
 
+def image_width(image):
+    width = image.attributes.get('width')
+    if width:
+        width = width.replace('%', '')
+        width = '{0:.2f}'.format(float(width) / 100)
+    return width
+
+
 class LaTeXImage(object):
 
-    __slots__ = ['image', 'id']
+    __slots__ = ['image', 'id', 'doc']
 
-    def __init__(self, image):
+    def __init__(self, image, doc):
         self.image = image
+        self.doc = doc
 
     def render(self):
         short_caption = self.image.attributes.get('short')
         if short_caption:
-            short_caption = pf.convert_text(short_caption,
-                                            extra_args=['--biblatex'],
-                                            input_format='markdown',
-                                            output_format='latex')
+            short_caption = conversion.convert_text(short_caption,
+                                                    self.doc,
+                                                    extra_args=['--biblatex'],
+                                                    input_format='markdown',
+                                                    output_format='latex')
 
         placement = self.image.attributes.get('placement', '')
         identifier = self.image.identifier
-        width = self.image.attributes.get('width')
-        if width:
-            width = width.replace('%', '')
-            width = '{0:.2f}'.format(float(width) / 100)
-
-        path = self.image.url
+        width = image_width(self.image)
+        path = assets.graphic(self.image.url, self.doc, width)
 
-        converted_caption = pf.convert_text(pf.Plain(*self.image.content),
-                                            extra_args=['--biblatex'],
-                                            input_format='panflute',
-                                            output_format='latex')
+        converted_caption = conversion.convert_text(
+            pf.Plain(*self.image.content),
+            self.doc,
+            extra_args=['--biblatex'],
+            input_format='panflute',
+            output_format='latex')
 
         values = {
             'placement': placement,
@@ -80,16 +95,36 @@ class LaTeXImage(object):
         return tex
 
 
+HANDLES = [(pf.Image, None)]
+
+
+@block_cache.cached_action(
+    'figure_divs',
+    lambda e, doc: isinstance(e, pf.Image) and doc.format == 'latex',
+    # the path of a converted figure (this also schedules its conversion
+    # if the block is cached but the file is gone)
+    depends=lambda e, doc: assets.graphic(e.url, doc, image_width(e)))
 def action(pandoc_image, doc):
     if not isinstance(pandoc_image, pf.Image) or not doc.format == 'latex':
         return None
 
-    image = LaTeXImage(pandoc_image)
+    image = LaTeXImage(pandoc_image, doc)
     return pf.RawInline(image.render(), format='latex')
 
 
+def prepare(doc):
+    assets.prepare(doc)
+
+
+def finalize(doc):
+    assets.finalize(doc)
+
+
 def main(doc=None):
-    return pf.run_filter(action, doc=doc)
+    return runner.run_filter(action,
+                             prepare=prepare,
+                             finalize=finalize,
+                             doc=doc)
 
 
 if __name__ == '__main__':
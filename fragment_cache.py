@@ -0,0 +1,211 @@
+r"""
+Persistent, content-addressed cache for fragment conversions.
+
+Results of conversion.convert_text are stored in an SQLite database,
+keyed by a hash of the fragment, its input/output format, extra_args
+and the pandoc version. Least recently used entries are evicted once the
+cache grows beyond its size limit.
+
+Usage:
+
+- The cache is on by default and lives in
+  $XDG_CACHE_HOME/panflutist/fragments.sqlite (~/.cache/... if unset).
+  Set PANFLUTIST_CACHE to use another file.
+- PANFLUTIST_CACHE_SIZE sets the size limit in bytes (default: 64 MiB).
+- Disable the cache for a document in its metadata:
+    ```yaml
+    conversion-cache: false
+    ```
+- Set `conversion-cache-stats: true` to print hit/miss counters to stderr.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+import panflute as pf
+
+DEFAULT_SIZE = 64 * 1024 * 1024
+
+SCHEMA = r"""
+CREATE TABLE IF NOT EXISTS fragments (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    atime INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS fragments_atime ON fragments (atime);
+CREATE TABLE IF NOT EXISTS pandoc (
+    binary TEXT PRIMARY KEY,
+    version TEXT NOT NULL
+);
+"""
+
+
+def cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'panflutist')
+
+
+def default_path():
+    path = os.environ.get('PANFLUTIST_CACHE')
+    if path:
+        return path
+    return os.path.join(cache_dir(), 'fragments.sqlite')
+
+
+def default_size():
+    return int(os.environ.get('PANFLUTIST_CACHE_SIZE', DEFAULT_SIZE))
+
+
+def fragment_source(text):
+    """Serialize a fragment (markdown string or panflute elements)."""
+    if isinstance(text, str):
+        return text
+    if isinstance(text, pf.Element):
+        text = [text]
+    return json.dumps([e.to_json() for e in text],
+                      sort_keys=True,
+                      ensure_ascii=False)
+
+
+class FragmentCache(object):
+
+    __slots__ = [
+        'path', 'max_size', 'connection', 'pandoc_version', 'hits', 'misses',
+        'touched', 'added'
+    ]
+
+    def __init__(self, path=None, max_size=None):
+        import sqlite3
+
+        self.path = path or default_path()
+        self.max_size = default_size() if max_size is None else max_size
+        self.hits = 0
+        self.misses = 0
+        # access times and new entries are written in one transaction
+        # on close()
+        self.touched = []
+        self.added = {}
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(self.path, timeout=30)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+        self.pandoc_version = self._pandoc_version()
+
+    def _pandoc_version(self):
+        # Asking pandoc for its version costs a subprocess, so remember it
+        # per binary (path, size and mtime).
+        binary = shutil.which('pandoc') or 'pandoc'
+        try:
+            stat = os.stat(binary)
+            binary = '{}:{}:{}'.format(binary, stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            pass
+
+        row = self.connection.execute(
+            'SELECT version FROM pandoc WHERE binary = ?',
+            (binary, )).fetchone()
+        if row:
+            return row[0]
+
+        version = pf.run_pandoc(args=['--version']).splitlines()[0]
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO pandoc (binary, version) VALUES (?, ?)',
+                (binary, version))
+        return version
+
+    def key(self, text, input_format, output_format, extra_args):
+        data = [
+            self.pandoc_version, input_format, output_format,
+            list(extra_args),
+            fragment_source(text)
+        ]
+        data = json.dumps(data, ensure_ascii=False)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def block_key(self, data):
+        data = json.dumps([self.pandoc_version, data], ensure_ascii=False)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        if key in self.added:
+            self.hits += 1
+            return self.added[key]
+        row = self.connection.execute(
+            'SELECT value FROM fragments WHERE key = ?', (key, )).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.touched.append((time.time_ns(), key))
+        return row[0]
+
+    def put(self, key, value):
+        self.added[key] = value
+
+    def flush(self):
+        now = time.time_ns()
+        with self.connection:
+            self.connection.executemany(
+                'UPDATE fragments SET atime = ? WHERE key = ?', self.touched)
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO fragments (key, value, size, atime) '
+                'VALUES (?, ?, ?, ?)',
+                [(key, value, len(value.encode('utf-8')), now)
+                 for (key, value) in self.added.items()])
+        self.touched = []
+        self.added = {}
+
+    def evict(self):
+        total = self.connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM fragments').fetchone()[0]
+        if total <= self.max_size:
+            return
+
+        excess = total - self.max_size
+        stale = []
+        for (key, size) in self.connection.execute(
+                'SELECT key, size FROM fragments ORDER BY atime'):
+            stale.append((key, ))
+            excess -= size
+            if excess <= 0:
+                break
+        with self.connection:
+            self.connection.executemany('DELETE FROM fragments WHERE key = ?',
+                                        stale)
+
+    def close(self):
+        self.flush()
+        self.evict()
+        self.connection.close()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+def open_cache(doc):
+    if not doc.get_metadata('conversion-cache', default=True):
+        return None
+    import sqlite3
+
+    try:
+        return FragmentCache()
+    except (OSError, sqlite3.Error) as e:
+        pf.debug('conversion cache disabled:', e)
+        return None
+
+
+def close_cache(doc, cache):
+    if cache is None:
+        return
+    if doc.get_metadata('conversion-cache-stats', default=False):
+        pf.debug('conversion cache:', json.dumps(cache.stats()))
+    cache.close()
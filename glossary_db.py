@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+r"""
+Shared glossary and abbreviation definitions for glossary_spans.py.
+
+A glossary file (YAML or CSV) is compiled once into an indexed SQLite
+store in the panflutist cache directory, with all descriptions already
+converted to LaTeX (in one batched pandoc run). Documents then resolve
+bare spans like [so]{.ac} by label; only the entries a document uses
+are defined in its preamble. The store is recompiled whenever the
+glossary file or the pandoc binary changes; concurrent runs (e.g. the
+workers of build.py) wait for the first one to compile it instead of
+each compiling their own. Malformed entries are reported and skipped.
+
+Usage:
+
+- A YAML glossary maps labels to attributes:
+    ```yaml
+    so:
+      short: SO
+      long: Stack Overflow
+    ptt:
+      name: Potato
+      description: Starchy *tuber*
+      plural: potatoes
+    ```
+  A CSV glossary has a header row with label, short, long, name, text,
+  plural, description and (optionally) sort columns.
+- Point a document at it with `glossary-db: glossary.yaml`.
+- Attributes on a span still take precedence over the glossary.
+- python glossary_db.py glossary.yaml compiles the store ahead of time.
+"""
+
+import argparse
+import contextlib
+import csv
+import hashlib
+import os
+import shutil
+import conversion
+import fragment_cache
+import panflute as pf
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+FIELDS = ['label', 'kind', 'short', 'long', 'name', 'text', 'plural',
+          'description', 'sort', 'source']
+
+SCHEMA = """
+CREATE TABLE entries (
+    label TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    short TEXT,
+    long TEXT,
+    name TEXT,
+    text TEXT,
+    plural TEXT,
+    description TEXT,
+    sort TEXT,
+    source TEXT
+);
+CREATE TABLE source (
+    stamp TEXT NOT NULL
+);
+"""
+
+# bump when the layout of the store changes
+VERSION = 3
+
+
+def store_path(source):
+    name = hashlib.sha256(os.path.abspath(source).encode('utf-8')).hexdigest()
+    return os.path.join(fragment_cache.cache_dir(), 'glossaries',
+                        name + '.sqlite')
+
+
+def stamp(source):
+    """Identifies the glossary file and pandoc version a store was built from."""
+    info = os.stat(source)
+    parts = [VERSION, os.path.abspath(source), info.st_mtime_ns, info.st_size]
+    binary = shutil.which('pandoc')
+    if binary is not None:
+        info = os.stat(binary)
+        parts += [binary, info.st_mtime_ns, info.st_size]
+    return ' '.join(str(part) for part in parts)
+
+
+def read_entries(source):
+    if os.path.splitext(source)[1].lower() == '.csv':
+        with open(source, newline='', encoding='utf-8') as f:
+            try:
+                rows = list(csv.DictReader(f))
+            except csv.Error as e:
+                pf.debug('glossary: cannot read {}: {}'.format(source, e))
+                return []
+    else:
+        import yaml
+
+        with open(source, encoding='utf-8') as f:
+            try:
+                data = yaml.safe_load(f) or {}
+            except yaml.YAMLError as e:
+                pf.debug('glossary: cannot read {}: {}'.format(source, e))
+                return []
+        if not isinstance(data, dict):
+            pf.debug('glossary: {} does not map labels to entries'.format(
+                source))
+            return []
+        rows = []
+        for (label, values) in data.items():
+            if not isinstance(values, dict):
+                pf.debug('glossary: skipping entry', label, '(not a mapping)')
+                continue
+            rows.append(dict(values, label=label))
+
+    entries = []
+    for row in rows:
+        row = {
+            key: str(value) if value not in (None, '') else None
+            for (key, value) in row.items()
+        }
+        label = (row.get('label') or '').lower()
+        if row.get('short') and row.get('long'):
+            kind = 'ac'
+        elif row.get('name') and row.get('description'):
+            kind = 'gl'
+        else:
+            pf.debug('glossary: skipping incomplete entry', label)
+            continue
+        row['label'] = label
+        row['kind'] = kind
+        entries.append(row)
+    return entries
+
+
+def convert_descriptions(entries, workers):
+    glossary = [entry for entry in entries if entry['kind'] == 'gl']
+    converted = conversion.convert_many(
+        [entry['description'] for entry in glossary],
+        extra_args=['--biblatex'],
+        workers=workers)
+    for (entry, tex) in zip(glossary, converted):
+        # the Markdown is kept to compare with definitions on spans
+        entry['source'] = entry['description']
+        entry['description'] = tex
+
+
+def compile_glossary(source, path=None, workers=None):
+    """Build the store for source; returns its path."""
+    import sqlite3
+
+    path = path or store_path(source)
+    entries = read_entries(source)
+    convert_descriptions(entries, workers or os.cpu_count() or 1)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # build next to the store and swap it in, so that concurrent builds
+    # never see a half-written store
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    connection = sqlite3.connect(temporary)
+    try:
+        connection.executescript(SCHEMA)
+        connection.executemany(
+            'INSERT OR REPLACE INTO entries VALUES '
+            '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [[entry.get(field) for field in FIELDS] for entry in entries])
+        connection.execute('INSERT INTO source VALUES (?)', (stamp(source), ))
+        connection.commit()
+    finally:
+        connection.close()
+    os.replace(temporary, path)
+    return path
+
+
+@contextlib.contextmanager
+def compile_lock(path):
+    """Held while compiling the store at path (a no-op without fcntl)."""
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.lock', 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class GlossaryDB(object):
+    """Read-only view of a compiled glossary; lookups are memoized."""
+
+    __slots__ = ['connection', 'entries']
+
+    def __init__(self, source):
+        import sqlite3
+
+        path = store_path(source)
+        if not self.is_current(path, source):
+            with compile_lock(path):
+                # another process may have compiled it while we waited
+                if not self.is_current(path, source):
+                    compile_glossary(source, path)
+        self.connection = sqlite3.connect(path)
+        self.entries = {}
+
+    @staticmethod
+    def is_current(path, source):
+        import sqlite3
+
+        if not os.path.exists(path):
+            return False
+        connection = sqlite3.connect(path)
+        try:
+            row = connection.execute('SELECT stamp FROM source').fetchone()
+        except sqlite3.Error:
+            return False
+        finally:
+            connection.close()
+        return row is not None and row[0] == stamp(source)
+
+    def lookup(self, label):
+        if label not in self.entries:
+            row = self.connection.execute(
+                'SELECT * FROM entries WHERE label = ?', (label, )).fetchone()
+            self.entries[label] = dict(zip(FIELDS, row)) if row else None
+        return self.entries[label]
+
+    def close(self):
+        self.connection.close()
+
+
+def open_glossary(doc):
+    source = doc.get_metadata('glossary-db', default=None)
+    if not source:
+        return None
+    import sqlite3
+
+    try:
+        return GlossaryDB(source)
+    except (OSError, sqlite3.Error) as e:
+        pf.debug('glossary database disabled:', e)
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('glossary')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count())
+    options = parser.parse_args(argv)
+    path = compile_glossary(options.glossary, workers=options.jobs)
+    print(path)
+
+
+if __name__ == '__main__':
+    main()
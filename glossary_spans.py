@@ -12,20 +12,47 @@ Usage:
 - Then, this filter will add \newacronym{LRU}{LRU}{Least Recently Used}
   for the definition of LRU and finally \gls{LRU} to every time the term
   is used in the text.
+- With `glossary-export: true` in the metadata, the definitions are not
+  added to header-includes but stored (unsorted, with their kind and
+  sort key) in the `glossary-definitions` metadata map, e.g. for
+  build.py to merge and sort them across chapters.
+- With `glossary-db: glossary.yaml`, spans without attributes such as
+  [so]{.ac} are looked up in a shared glossary (see glossary_db.py).
+- With `glossary-sort: true`, the entries are sorted and grouped by the
+  filter and defined in that order, so \printunsrtglossaries can print
+  them without a makeglossaries/xindy run. Sorting follows the
+  `glossary-locale` (or `lang`) metadata; a `sort="..."` attribute (or
+  sort column in the glossary database) overrides an entry's sort key.
+- With `glossary-file: glossary-definitions.tex`, the definitions are
+  written to that file (only if its content changed) and the preamble
+  gets a single \input instead of one header-include per entry.
+- If a label is defined more than once, the last definition wins. A
+  label used both with .ac and with .gl keeps the kind it was first
+  used as; the other uses are reported and define nothing.
+- Set `glossary-verbose: true` to log every abbreviation found.
 
 (see https://groups.google.com/forum/#!topic/pandoc-discuss/Bz1cG55BKjM)
 """
 
-from jinja2tex import latex_env
+from jinja2tex import template
+import conversion
+import glossary_db
+import hashlib
+import locale
+import os
 import panflute as pf
+import runner
+import unicodedata
 
-USE_TERM = latex_env.from_string(
+USE_TERM = template(
     r"<% if uppercase %><% if plural %>\Glspl<% else %>\Gls<% endif %><% else %><% if plural %>\glspl<% else %>\gls<% endif %><% endif %>{<< label >>}")
 
-DEFINE_ABBREVIATION = latex_env.from_string(
+DEFINE_ABBREVIATION = template(
     r"\newabbreviation{<< label >>}{<< short >>}{<< long >>}")
 
-DEFINE_GLOSSARY_ENTRY = latex_env.from_string(r"""
+SET_GROUP = template(r"\GlsXtrSetField{<< label >>}{group}{<< group >>}")
+
+DEFINE_GLOSSARY_ENTRY = template(r"""
 \newglossaryentry{<< label >>}{
     name={<< name >>},
     <% if text %>text={<< text >>},<% endif %>
@@ -35,9 +62,53 @@ DEFINE_GLOSSARY_ENTRY = latex_env.from_string(r"""
 """)
 
 
+KINDS = {'ac': 'an abbreviation', 'gl': 'a glossary entry'}
+
+
 def prepare(doc):
     doc.abbrs = {}
     doc.glsentries = {}
+    doc.glossary = glossary_db.open_glossary(doc)
+    doc.glossary_verbose = doc.get_metadata('glossary-verbose', default=False)
+
+
+def definition(values):
+    """
+    values without the converted description, which entries from the
+    glossary database already have and those from spans do not yet.
+    """
+    return {key: value for (key, value) in values.items()
+            if key != 'description'}
+
+
+def define(entries, label, values):
+    previous = entries.get(label)
+    if previous is not None and definition(previous) != definition(values):
+        pf.debug('glossary: conflicting definitions of {}, keeping the last'.
+                 format(label))
+    entries[label] = values
+
+
+def defined_as_other(label, kind, doc):
+    """
+    Whether label is already used as the other kind; a label keeps the
+    kind it was first used as, since glossaries rejects both.
+    """
+    other = doc.glsentries if kind == 'ac' else doc.abbrs
+    if label not in other:
+        return False
+    pf.debug('glossary: {} is already {}, ignoring its use as {}'.format(
+        label, KINDS['gl' if kind == 'ac' else 'ac'], KINDS[kind]))
+    return True
+
+
+def lookup(label, kind, doc):
+    if doc.glossary is None:
+        return None
+    entry = doc.glossary.lookup(label)
+    if entry is None or entry['kind'] != kind:
+        return None
+    return entry
 
 
 def ac_latex(e, doc):
@@ -45,17 +116,28 @@ def ac_latex(e, doc):
     _short = e.attributes.get('short')
     _long = e.attributes.get('long')
 
-    pf.debug("ac found: ", label, _short, _long)
+    if doc.glossary_verbose:
+        pf.debug("ac found: ", label, _short, _long)
 
-    if _short and _long:
+    if defined_as_other(label, 'ac', doc):
+        pass
+    elif _short and _long:
         values = {
             'label': label,
             'short': _short,
             'long': _long,
-            'uppercase': 'up' in e.classes,
-            'plural': 'pl' in e.classes
+            'sort': e.attributes.get('sort')
         }
-        doc.abbrs[label] = values
+        define(doc.abbrs, label, values)
+    elif label not in doc.abbrs:
+        entry = lookup(label, 'ac', doc)
+        if entry is not None:
+            doc.abbrs[label] = {
+                'label': label,
+                'short': entry['short'],
+                'long': entry['long'],
+                'sort': entry['sort']
+            }
 
     tex = USE_TERM.render(label=label, uppercase='up' in e.classes)
     return pf.RawInline(tex, format='latex')
@@ -66,30 +148,39 @@ def gl_latex(e, doc):
     name = e.attributes.get('name')
     description = e.attributes.get('description')
 
-    if label and name and description:
+    if defined_as_other(label, 'gl', doc):
+        pass
+    elif label and name and description:
+        # the description is converted in finalize, once per label
         values = {
-            'label':
-            label,
-            'name':
-            name,
-            'description':
-            pf.convert_text(description,
-                            extra_args=['--biblatex'],
-                            input_format='markdown',
-                            output_format='latex'),
-            'text':
-            e.attributes.get('text'),
-            'plural':
-            e.attributes.get('plural'),
-            'uppercase':
-            'up' in e.classes
+            'label': label,
+            'name': name,
+            'source': description,
+            'text': e.attributes.get('text'),
+            'plural': e.attributes.get('plural'),
+            'sort': e.attributes.get('sort')
         }
-        doc.glsentries[label] = values
+        define(doc.glsentries, label, values)
+    elif label not in doc.glsentries:
+        entry = lookup(label, 'gl', doc)
+        if entry is not None:
+            doc.glsentries[label] = {
+                'label': label,
+                'name': entry['name'],
+                'source': entry['source'],
+                'description': entry['description'],
+                'text': entry['text'],
+                'plural': entry['plural'],
+                'sort': entry['sort']
+            }
 
     tex = USE_TERM.render(label=label, plural='pl' in e.classes, uppercase='up' in e.classes)
     return pf.RawInline(tex, format='latex')
 
 
+HANDLES = [(pf.Span, 'ac'), (pf.Span, 'gl')]
+
+
 def action(e, doc):
     if isinstance(e, pf.Span) and doc.format == 'latex':
         if 'ac' in e.classes:
@@ -100,16 +191,139 @@ def action(e, doc):
         return None
 
 
+def locale_name(doc):
+    return doc.get_metadata('glossary-locale', default=None) or \
+        doc.get_metadata('lang', default=None)
+
+
+def collation(name):
+    """Sort key function for a locale like de-DE (call under setlocale)."""
+    if name:
+        name = name.replace('-', '_')
+        for candidate in (name + '.UTF-8', name):
+            try:
+                locale.setlocale(locale.LC_COLLATE, candidate)
+                return locale.strxfrm
+            except locale.Error:
+                pass
+        pf.debug('glossary: locale not available:', name)
+    return fallback_key
+
+
+def fallback_key(text):
+    # without a locale, sort accented letters with their base letters
+    decomposed = unicodedata.normalize('NFKD', text)
+    return (''.join(c for c in decomposed
+                    if not unicodedata.combining(c)).casefold(), text)
+
+
+def letter_group(text):
+    letter = unicodedata.normalize('NFKD', text.strip()[:1])[:1].upper()
+    return letter if letter.isalpha() else 'glssymbols'
+
+
+def sort_definitions(definitions, name):
+    """
+    Sort (label, text, tex) definitions by text in the locale name and
+    set their letter groups.
+    """
+    previous = locale.setlocale(locale.LC_COLLATE)
+    try:
+        key = collation(name)
+        keyed = [(letter_group(text) != 'glssymbols', key(text), label, text,
+                  tex) for (label, text, tex) in definitions]
+    finally:
+        locale.setlocale(locale.LC_COLLATE, previous)
+
+    keyed.sort(key=lambda entry: entry[:3])
+    return [(label, text, tex + '\n' +
+             SET_GROUP.render(label=label, group=letter_group(text)))
+            for (_, _, label, text, tex) in keyed]
+
+
+def convert_descriptions(doc):
+    pending = [
+        values for values in doc.glsentries.values()
+        if 'description' not in values
+    ]
+    converted = conversion.convert_many(
+        [values['source'] for values in pending],
+        doc,
+        extra_args=['--biblatex'])
+    for (values, tex) in zip(pending, converted):
+        values['description'] = tex
+
+
+def entries(doc):
+    """(kind, label, sort text, tex) of all used entries, unsorted."""
+    convert_descriptions(doc)
+    defined = [('ac', label, values.get('sort') or values['short'],
+                DEFINE_ABBREVIATION.render(**values))
+               for label, values in doc.abbrs.items()]
+    defined += [('gl', label, values.get('sort') or values['name'],
+                 DEFINE_GLOSSARY_ENTRY.render(**values))
+                for label, values in doc.glsentries.items()]
+    return defined
+
+
+def definitions(doc):
+    """(label, tex) of all used entries, sorted with glossary-sort."""
+    defined = [(label, text, tex) for (_, label, text, tex) in entries(doc)]
+    if doc.get_metadata('glossary-sort', default=False):
+        defined = sort_definitions(defined, locale_name(doc))
+    return [(label, tex) for (label, _, tex) in defined]
+
+
+def write_if_changed(path, text):
+    data = text.encode('utf-8')
+    try:
+        with open(path, 'rb') as f:
+            if hashlib.sha256(f.read()).digest() == hashlib.sha256(
+                    data).digest():
+                # keep the timestamp, so latexmk & co. see no change
+                return
+    except OSError:
+        pass
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary, 'wb') as f:
+        f.write(data)
+    os.replace(temporary, path)
+
+
+def export(doc):
+    doc.metadata['glossary-definitions'] = pf.MetaMap(
+        *[('{}:{}'.format(kind, label),
+           pf.MetaMap(kind=pf.MetaString(kind),
+                      label=pf.MetaString(label),
+                      sort=pf.MetaString(text),
+                      tex=pf.MetaInlines(pf.RawInline(tex, format='latex'))))
+          for (kind, label, text, tex) in entries(doc)])
+
+
 def finalize(doc):
+    if doc.glossary is not None:
+        doc.glossary.close()
+        doc.glossary = None
+
     if doc.format == 'latex':
-        tex = [r'\makeglossaries']
-        for _, values in doc.abbrs.items():
-            tex_acronym = DEFINE_ABBREVIATION.render(**values)
-            tex.append(tex_acronym)
+        if doc.get_metadata('glossary-export', default=False):
+            return export(doc)
+
+        tex = [tex for (_, tex) in definitions(doc)]
+        # entries printed with \printunsrtglossaries need no indexing
+        if not doc.get_metadata('glossary-sort', default=False):
+            tex.insert(0, r'\makeglossaries')
 
-        for _, values in doc.glsentries.items():
-            tex_acronym = DEFINE_GLOSSARY_ENTRY.render(**values)
-            tex.append(tex_acronym)
+        path = doc.get_metadata('glossary-file', default=None)
+        if path:
+            # finalize runs before deferred conversions are patched in
+            write_if_changed(
+                path, conversion.resolve_text('\n'.join(tex) + '\n', doc))
+            tex = [r'\input{{{}}}'.format(path.replace(os.sep, '/'))]
 
         tex = [
             pf.MetaInlines(pf.RawInline(line, format='latex')) for line in tex
@@ -122,7 +336,10 @@ def finalize(doc):
 
 
 def main(doc=None):
-    return pf.run_filter(action, prepare=prepare, finalize=finalize, doc=doc)
+    return runner.run_filter(action,
+                             prepare=prepare,
+                             finalize=finalize,
+                             doc=doc)
 
 
 if __name__ == '__main__':
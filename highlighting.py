@@ -0,0 +1,213 @@
+r"""
+In-process syntax highlighting of code listings with Pygments.
+
+Instead of a minted environment (which runs pygmentize from LaTeX on
+every compile and needs -shell-escape), listings are highlighted by
+the filter and emitted as fancyvrb Verbatim environments with
+commandchars. Listings are collected during the walk and highlighted
+together in finalize() by a pool of worker processes, one per core by
+default (see `conversion-workers`). Results are kept in the persistent
+conversion cache, keyed by the code, language, options, style and
+Pygments version.
+
+Usage:
+
+- Enable it in the document metadata, optionally with a Pygments style:
+    ```yaml
+    code-highlighting: pygments
+    pygments-style: friendly
+    ```
+- Add \usepackage{fancyvrb,xcolor} to the preamble. The style's color
+  definitions are added to header-includes. Floating listings (and
+  \captionof{listing}) need a listing float, e.g. from the newfloat
+  package: \DeclareFloatingEnvironment[name=Listing]{listing}.
+- Supported mintedopts: linenos, mathescape, escapeinside, tabsize,
+  stripnl and fancyvrb options such as fontsize, frame, firstnumber or
+  xleftmargin.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+import re
+import panflute as pf
+
+PLACEHOLDER = 'PANFLUTISTLISTING{:08d}Z'
+PLACEHOLDER_RE = re.compile(r'PANFLUTISTLISTING(\d{8})Z')
+
+# minted options Pygments handles itself
+FORMATTER_OPTIONS = ['mathescape', 'escapeinside']
+LEXER_OPTIONS = ['tabsize', 'stripnl']
+
+# minted options that are fancyvrb options as well
+VERBATIM_OPTIONS = [
+    'baselinestretch', 'firstline', 'firstnumber', 'fontfamily', 'fontseries',
+    'fontshape', 'fontsize', 'frame', 'framerule', 'framesep', 'gobble',
+    'label', 'lastline', 'numbers', 'numbersep', 'rulecolor', 'samepage',
+    'showspaces', 'showtabs', 'stepnumber', 'xleftmargin', 'xrightmargin'
+]
+
+# listings are only highlighted in worker processes from this many on
+MIN_PARALLEL = 8
+
+
+def parse_options(text):
+    """Split minted options like 'linenos=false, frame={lines}'."""
+    options = []
+    (depth, start) = (0, 0)
+    text = text or ''
+    for (i, c) in enumerate(text + ','):
+        if c == '{':
+            depth += 1
+        elif c == '}':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            option = text[start:i].strip()
+            start = i + 1
+            if option:
+                (key, _, value) = option.partition('=')
+                options.append((key.strip(), value.strip() or None))
+    return options
+
+
+def is_true(value):
+    return value is None or value.lower() == 'true'
+
+
+def highlight(job):
+    """Highlight one listing; runs in worker processes."""
+    from pygments import highlight as pygmentize
+    from pygments.formatters import LatexFormatter
+    from pygments.lexers import get_lexer_by_name
+    from pygments.util import ClassNotFound
+
+    (code, language, mintedopts, style) = job
+    lexer_options = {}
+    formatter_options = {'style': style}
+    verbatim = []
+    for (key, value) in parse_options(mintedopts):
+        if key == 'linenos':
+            if is_true(value):
+                verbatim.append('numbers=left')
+        elif key in FORMATTER_OPTIONS:
+            formatter_options[key] = value if key == 'escapeinside' \
+                else is_true(value)
+        elif key in LEXER_OPTIONS:
+            lexer_options[key] = int(value) if key == 'tabsize' \
+                else is_true(value)
+        elif key in VERBATIM_OPTIONS:
+            verbatim.append(key if value is None else '{}={}'.format(
+                key, value))
+        else:
+            pf.debug('highlighting: ignoring minted option', key)
+    formatter_options['verboptions'] = ','.join(verbatim)
+
+    try:
+        lexer = get_lexer_by_name(language, **lexer_options)
+    except ClassNotFound:
+        lexer = get_lexer_by_name('text', **lexer_options)
+    return pygmentize(code, lexer, LatexFormatter(**formatter_options)).rstrip()
+
+
+def style_definitions(style):
+    from pygments.formatters import LatexFormatter
+
+    return LatexFormatter(style=style).get_style_defs()
+
+
+def available():
+    try:
+        import pygments
+    except ImportError:
+        return False
+    return True
+
+
+class ListingBatch(object):
+    """Listings registered during the walk, highlighted on resolve()."""
+
+    __slots__ = ['style', 'cache', 'workers', 'jobs', 'keys', 'results']
+
+    def __init__(self, style, cache=None, workers=1):
+        self.style = style
+        self.cache = cache
+        self.workers = max(1, workers)
+        self.jobs = []
+        self.keys = []
+        self.results = []
+
+    def key(self, job):
+        import pygments
+
+        return self.cache.block_key(['pygments', pygments.__version__] +
+                                    list(job))
+
+    def add(self, code, language, mintedopts):
+        job = (code, language, mintedopts or '', self.style)
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.key(job)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                self.results.append(cached)
+                return PLACEHOLDER.format(len(self.results) - 1)
+
+        self.results.append(None)
+        self.jobs.append((len(self.results) - 1, job))
+        self.keys.append(cache_key)
+        return PLACEHOLDER.format(len(self.results) - 1)
+
+    def resolve(self):
+        jobs = [job for (_, job) in self.jobs]
+        if self.workers > 1 and len(jobs) >= MIN_PARALLEL:
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                chunksize = max(1, len(jobs) // (4 * self.workers))
+                highlighted = list(pool.map(highlight, jobs,
+                                            chunksize=chunksize))
+        else:
+            highlighted = [highlight(job) for job in jobs]
+
+        for ((index, _), cache_key, tex) in zip(self.jobs, self.keys,
+                                                highlighted):
+            self.results[index] = tex
+            if cache_key is not None:
+                self.cache.put(cache_key, tex)
+        self.jobs = []
+        self.keys = []
+
+    def patch(self, e, doc):
+        if isinstance(e, pf.RawBlock) and PLACEHOLDER_RE.search(e.text):
+            e.text = PLACEHOLDER_RE.sub(
+                lambda m: self.results[int(m.group(1))], e.text)
+
+
+def prepare(doc):
+    doc.listings = None
+    if doc.format != 'latex' or doc.get_metadata(
+            'code-highlighting', default='minted') != 'pygments':
+        return
+    if not available():
+        pf.debug('highlighting: Pygments is not installed, using minted')
+        return
+    workers = doc.get_metadata('conversion-workers',
+                               default=os.cpu_count() or 1)
+    doc.listings = ListingBatch(
+        doc.get_metadata('pygments-style', default='default'),
+        getattr(doc, 'fragment_cache', None), int(workers))
+
+
+def finalize(doc):
+    batch = getattr(doc, 'listings', None)
+    if batch is None:
+        return
+    if batch.results:
+        batch.resolve()
+        doc.walk(batch.patch)
+    doc.listings = None
+
+    # also needed for listings reused from the block cache
+    tex = pf.MetaInlines(
+        pf.RawInline(style_definitions(batch.style), format='latex'))
+    if 'header-includes' in doc.metadata:
+        doc.metadata['header-includes'].content.append(tex)
+    else:
+        doc.metadata['header-includes'] = pf.MetaList(tex)
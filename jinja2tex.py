@@ -1,5 +1,17 @@
-import jinja2
+"""
+Jinja2 environment for LaTeX templates.
+
+Templates are declared with template() at import time but only compiled
+on first render, so filters that find nothing to do (or run for another
+output format) never import jinja2. Compiled templates are kept in a
+bytecode cache (PANFLUTIST_TEMPLATE_CACHE, default
+$XDG_CACHE_HOME/panflutist/templates), keyed by the template source, so
+later runs skip the compilation as well.
+"""
+
+import hashlib
 import os
+import fragment_cache
 
 # latex_env = jinja2.Environment(
 #         block_start_string = r'\BLOCK{',
@@ -15,16 +27,91 @@ import os
 #         loader = jinja2.FileSystemLoader(os.path.abspath('.'))
 #     )
 
-# I prefer a more concise style
-latex_env = jinja2.Environment(block_start_string='<%',
-                               block_end_string='%>',
-                               variable_start_string='<<',
-                               variable_end_string='>>',
-                               comment_start_string='<#',
-                               comment_end_string='#>',
-                               line_statement_prefix='%%',
-                               line_comment_prefix='%#',
-                               trim_blocks=False,
-                               autoescape=False,
-                               loader=jinja2.FileSystemLoader(
-                                   os.path.abspath('.')))
+# sources of the templates declared with template(), by name
+SOURCES = {}
+
+_environment = None
+
+
+def bytecode_cache():
+    import jinja2
+
+    directory = os.environ.get('PANFLUTIST_TEMPLATE_CACHE') or os.path.join(
+        fragment_cache.cache_dir(), 'templates')
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError:
+        return None
+    return jinja2.FileSystemBytecodeCache(directory)
+
+
+def environment():
+    global _environment
+    if _environment is None:
+        import jinja2
+
+        # I prefer a more concise style
+        _environment = jinja2.Environment(
+            block_start_string='<%',
+            block_end_string='%>',
+            variable_start_string='<<',
+            variable_end_string='>>',
+            comment_start_string='<#',
+            comment_end_string='#>',
+            line_statement_prefix='%%',
+            line_comment_prefix='%#',
+            trim_blocks=False,
+            autoescape=False,
+            loader=jinja2.ChoiceLoader([
+                jinja2.FunctionLoader(SOURCES.get),
+                jinja2.FileSystemLoader(os.path.abspath('.'))
+            ]),
+            bytecode_cache=bytecode_cache())
+    return _environment
+
+
+def __getattr__(name):
+    if name == 'latex_env':
+        return environment()
+    raise AttributeError(name)
+
+
+class LazyTemplate(object):
+
+    __slots__ = ['name', 'template']
+
+    def __init__(self, name):
+        self.name = name
+        self.template = None
+
+    def compiled(self):
+        if self.template is None:
+            self.template = environment().get_template(self.name)
+        return self.template
+
+    def render(self, *args, **kwargs):
+        return self.compiled().render(*args, **kwargs)
+
+    def generate(self, *args, **kwargs):
+        return self.compiled().generate(*args, **kwargs)
+
+    @property
+    def module(self):
+        return self.compiled().module
+
+
+TEMPLATES = []
+
+
+def template(source):
+    """Declare a template; it is compiled when first rendered."""
+    name = 'panflutist:' + hashlib.sha1(source.encode('utf-8')).hexdigest()
+    SOURCES[name] = source
+    TEMPLATES.append(LazyTemplate(name))
+    return TEMPLATES[-1]
+
+
+def compile_all():
+    """Compile all declared templates, e.g. before forking workers."""
+    for t in TEMPLATES:
+        t.compiled()
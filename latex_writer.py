@@ -0,0 +1,240 @@
+r"""
+In-process LaTeX writer for common inline panflute elements.
+
+Most fragments the filters convert (table cells, captions, quotes) only
+contain a handful of inline elements. write() renders those the way
+pandoc's LaTeX writer does (with --biblatex for citations) and returns
+None for anything else, in which case conversion.convert_text falls back
+to pandoc.
+
+Supported: Plain and Para blocks containing Str, Space, SoftBreak, Emph,
+Strong, SmallCaps, Code (without classes), Quoted, RawInline and Cite
+with a numeric page locator. Markdown strings are only handled if they
+are plain text, i.e. contain nothing pandoc's markdown reader would
+interpret.
+
+Usage:
+
+- Used by conversion.convert_text and convert_many for LaTeX output.
+- tests/test_latex_writer.py compares the writer's output with pandoc's
+  for a set of sample fragments.
+"""
+
+import re
+import panflute as pf
+
+TEXT = 'text'
+CODE = 'code'
+
+ESCAPES = {
+    '{': r'\{',
+    '}': r'\}',
+    '$': r'\$',
+    '%': r'\%',
+    '&': r'\&',
+    '_': r'\_',
+    '#': r'\#',
+    '^': r'\^{}',
+    '[': r'{[}',
+    ']': r'{]}',
+    '\u00a0': '~',
+    '\u200b': r'\hspace{0pt}',
+    '\u202f': r'\,',
+}
+
+COMMANDS = {
+    '~': r'\textasciitilde',
+    '\\': r'\textbackslash',
+    '|': r'\textbar',
+    '<': r'\textless',
+    '>': r'\textgreater',
+    "'": r'\textquotesingle',
+}
+
+LIGATURES = {
+    '\u2014': '---',
+    '\u2013': '--',
+}
+
+QUOTES = {
+    '\u2018': '`',
+    '\u2019': "'",
+    '\u201c': '``',
+    '\u201d': "''",
+}
+
+CITE_COMMANDS = {
+    'NormalCitation': r'\autocite',
+    'AuthorInText': r'\textcite',
+    'SuppressAuthor': r'\autocite*',
+}
+
+MULTICITE_COMMANDS = {
+    'NormalCitation': r'\autocites',
+    'AuthorInText': r'\textcites',
+    'SuppressAuthor': r'\autocites*',
+}
+
+LOCATOR = re.compile(r'^\d+(?:[-\u2013]\d+)?$')
+
+# markdown that is plain text to pandoc: no markup characters, no
+# smart punctuation, nothing that could start a list and no period
+# before a space (abbreviations like "p. 5" get a non-breaking space)
+PLAIN_MARKDOWN = re.compile(r'^[^\W\d_][\w ,.;:!?()/+=-]*$')
+NOT_PLAIN_MARKDOWN = re.compile(r'\.\.|--|  |^\w[.)]|_|\.\s')
+
+# characters written as (or starting with) a backquote
+BACKQUOTES = '`\u2018\u201c'
+
+
+class Unsupported(Exception):
+    pass
+
+
+def escape(text, context=TEXT):
+    out = []
+    for (i, c) in enumerate(text):
+        following = text[i + 1] if i + 1 < len(text) else ''
+        if c in ESCAPES:
+            out.append(ESCAPES[c])
+        elif c in COMMANDS or (context == CODE and c == '`'):
+            out.append(COMMANDS.get(c) or r'\textasciigrave')
+            if following.isalpha() and context == TEXT:
+                out.append(' ')
+            elif following == '' or following.isspace() or context != TEXT:
+                out.append('{}')
+        elif c == '-' and following == '-':
+            out.append(r'-\/')
+        elif context == CODE:
+            out.append(c)
+        elif c in '?!' and following and following in BACKQUOTES:
+            # keeps ?` and !` from becoming inverted punctuation
+            out.append(c + r'{\kern0pt}')
+        elif c in LIGATURES:
+            out.append(LIGATURES[c])
+        elif c == '\u2026':
+            out.append(r'\ldots')
+            if following.isalpha():
+                out.append(' ')
+            elif following == '' or following.isspace():
+                out.append('{}')
+        elif c in QUOTES:
+            out.append(QUOTES[c])
+            if following in ('`', '\''):
+                out.append(r'\,')
+        else:
+            out.append(c)
+    return ''.join(out)
+
+
+def write_inlines(elements, biblatex):
+    return ''.join(write_inline(e, biblatex) for e in elements)
+
+
+def write_locator(suffix, biblatex):
+    if not all(isinstance(e, (pf.Str, pf.Space)) for e in suffix):
+        raise Unsupported(suffix)
+    text = pf.stringify(pf.Span(*suffix)).lstrip(',; ')
+    if text and not LOCATOR.match(text):
+        raise Unsupported(suffix)
+    return escape(text)
+
+
+def write_cite_arguments(citation, biblatex):
+    prefix = write_inlines(citation.prefix, biblatex)
+    suffix = write_locator(citation.suffix, biblatex)
+    if prefix:
+        return '[{}][{}]{{{}}}'.format(prefix, suffix, citation.id)
+    if suffix:
+        return '[{}]{{{}}}'.format(suffix, citation.id)
+    return '{{{}}}'.format(citation.id)
+
+
+def write_cite(e, biblatex):
+    if not biblatex:
+        raise Unsupported(e)
+    citations = list(e.citations)
+    mode = citations[0].mode
+    if len(citations) == 1:
+        return CITE_COMMANDS[mode] + write_cite_arguments(
+            citations[0], biblatex)
+    if all(not c.prefix and not c.suffix for c in citations):
+        return '{}{{{}}}'.format(CITE_COMMANDS[mode],
+                                 ','.join(c.id for c in citations))
+    return MULTICITE_COMMANDS[mode] + ''.join(
+        write_cite_arguments(c, biblatex) for c in citations)
+
+
+def write_quoted(e, biblatex):
+    content = list(e.content)
+    inner = write_inlines(content, biblatex)
+    if content and isinstance(content[0], pf.Quoted):
+        inner = r'\,' + inner
+    if content and isinstance(content[-1], pf.Quoted):
+        inner = inner + r'\,'
+    if e.quote_type == 'DoubleQuote':
+        return '``' + inner + "''"
+    return '`' + inner + "'"
+
+
+def write_inline(e, biblatex):
+    if isinstance(e, pf.Str):
+        return escape(e.text)
+    elif isinstance(e, (pf.Space, pf.SoftBreak)):
+        return ' '
+    elif isinstance(e, pf.Emph):
+        return r'\emph{' + write_inlines(e.content, biblatex) + '}'
+    elif isinstance(e, pf.Strong):
+        return r'\textbf{' + write_inlines(e.content, biblatex) + '}'
+    elif isinstance(e, pf.SmallCaps):
+        return r'\textsc{' + write_inlines(e.content, biblatex) + '}'
+    elif isinstance(e, pf.Code) and not e.classes:
+        return r'\texttt{' + escape(e.text, CODE).replace(' ', '\\ ') + '}'
+    elif isinstance(e, pf.Quoted):
+        return write_quoted(e, biblatex)
+    elif isinstance(e, pf.RawInline):
+        return e.text if e.format in ('latex', 'tex') else ''
+    elif isinstance(e, pf.Cite):
+        return write_cite(e, biblatex)
+    raise Unsupported(e)
+
+
+def write_markdown(text):
+    text = text.strip()
+    if '\n' in text or not PLAIN_MARKDOWN.match(text) \
+            or NOT_PLAIN_MARKDOWN.search(text):
+        raise Unsupported(text)
+    return escape(text)
+
+
+def write_blocks(blocks, biblatex):
+    out = []
+    for block in blocks:
+        if not isinstance(block, (pf.Plain, pf.Para)):
+            raise Unsupported(block)
+        out.append(write_inlines(block.content, biblatex))
+    return '\n\n'.join(out)
+
+
+def write(text, input_format='panflute', extra_args=None):
+    """
+    Render a fragment to LaTeX, or return None if it needs pandoc.
+    """
+    extra_args = list(extra_args or [])
+    biblatex = '--biblatex' in extra_args
+    if [arg for arg in extra_args if arg != '--biblatex']:
+        return None
+
+    try:
+        if input_format == 'markdown' and isinstance(text, str):
+            return write_markdown(text)
+        elif input_format == 'panflute':
+            if isinstance(text, pf.Doc):
+                text = text.content
+            elif isinstance(text, pf.Element):
+                text = [text]
+            return write_blocks(text, biblatex)
+    except Unsupported:
+        pass
+    return None
+
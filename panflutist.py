@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+"""
+Run all panflutist filters in a single process and a single AST walk.
+
+Instead of chaining every filter as its own --filter (one interpreter
+start, one JSON round-trip and one walk each), use this script once.
+For every element, the filters' actions are applied in the order listed
+in FILTERS; an element replaced by one filter is passed on to the next.
+prepare and finalize functions run in the same order. If a filter's
+action raises, the run fails as it would with the filter on its own;
+the error names the filter and the element it failed on. With
+profiling on (see profiling.py), each filter's action is timed on its
+own; the walk as a whole is not timed per element, so no element is
+counted twice.
+
+Filters declare the elements they handle in HANDLES, a list of (type,
+class) pairs; class None matches every element of the type. Before the
+walk, the document is indexed once: only elements a filter handles and
+their ancestors are walked, so subtrees without any such element (most
+paragraphs of a long document) are skipped entirely. A filter without
+HANDLES sees every element.
+
+Usage:
+
+- pandoc --filter=panflutist.py ...
+- Select filters, and their order, per document in the metadata:
+    ```yaml
+    panflutist:
+      - glossary_spans
+      - textquote
+      - reference_spans
+    ```
+"""
+
+from functools import partial
+import importlib
+import panflute as pf
+import runner
+
+FILTERS = [
+    'capital_spans',
+    'glossary_spans',
+    'textquote',
+    'figure_divs',
+    'table_divs',
+    'code_divs',
+    'unnumbered_sections',
+    'reference_spans',
+]
+
+
+class Filter(object):
+
+    __slots__ = ['name', 'action', 'prepare', 'finalize', 'handles']
+
+    def __init__(self, name):
+        module = importlib.import_module(name)
+        self.name = name
+        self.prepare = getattr(module, 'prepare', None)
+        self.finalize = getattr(module, 'finalize', None)
+        tags = getattr(module, 'TAGS', None)
+        if tags is not None:
+            self.action = partial(pf.yaml_filter, tags=tags)
+        else:
+            self.action = module.action
+        self.handles = None
+        if hasattr(module, 'HANDLES'):
+            self.handles = runner.handled_classes(module.HANDLES)
+
+    def accepts(self, e):
+        if self.handles is None:
+            return True
+        classes = self.handles.get(type(e), False)
+        if classes is False:
+            return False
+        return classes is None or any(cls in classes for cls in e.classes)
+
+    def profile(self, profiler):
+        self.action = profiler.wrap_action(self.name, self.action)
+        if self.prepare is not None:
+            self.prepare = profiler.wrap(self.name, 'prepare', self.prepare)
+        if self.finalize is not None:
+            self.finalize = profiler.wrap(self.name, 'finalize',
+                                          self.finalize)
+
+
+def selected_filters(doc):
+    names = doc.get_metadata('panflutist', default=FILTERS)
+    if isinstance(names, str):
+        names = [names]
+    unknown = [name for name in names if name not in FILTERS]
+    if unknown:
+        raise ValueError('unknown panflutist filter(s): {}'.format(
+            ', '.join(unknown)))
+    return [Filter(name) for name in names]
+
+
+def build_index(doc, filters):
+    """
+    ids of the elements handled by one of filters and of all their
+    ancestors, or None if a filter handles every element.
+    """
+    if any(f.handles is None for f in filters):
+        return None
+    handles = {}
+    for f in filters:
+        for (kind, classes) in f.handles.items():
+            if classes is None or handles.get(kind, ()) is None:
+                handles[kind] = None
+            else:
+                handles.setdefault(kind, set()).update(classes)
+    index = set()
+
+    def visit(e):
+        classes = handles.get(type(e), False)
+        found = classes is None or (classes is not False and
+                                    not classes.isdisjoint(e.classes))
+        for name in e._children:
+            child = getattr(e, name)
+            if isinstance(child, pf.ListContainer):
+                children = child.list
+            elif isinstance(child, pf.DictContainer):
+                children = child.dict.values()
+            elif child is None:
+                continue
+            else:
+                children = (child, )
+            for grandchild in children:
+                # leaves (mostly Str and Space) only need a visit if handled
+                if (grandchild._children or type(grandchild) in handles) \
+                        and visit(grandchild):
+                    found = True
+        if found:
+            index.add(id(e))
+        return found
+
+    visit(doc)
+    return index
+
+
+def prepare(doc):
+    doc.filters = selected_filters(doc)
+    profiler = getattr(doc, 'profiler', None)
+    if profiler is not None:
+        for f in doc.filters:
+            f.profile(profiler)
+    for f in doc.filters:
+        if f.prepare is not None:
+            f.prepare(doc)
+
+
+def action(e, doc):
+    current = e
+    for f in doc.filters:
+        if not f.accepts(current):
+            continue
+        try:
+            result = f.action(current, doc)
+        except Exception as error:
+            raise RuntimeError('panflutist: {} failed on {}: {}: {}'.format(
+                f.name,
+                type(current).__name__,
+                type(error).__name__, error)) from error
+        if result is None or result is current:
+            continue
+        if isinstance(result, list):
+            return result
+        current = result
+    if current is not e:
+        return current
+
+
+def finalize(doc):
+    for f in doc.filters:
+        if f.finalize is not None:
+            f.finalize(doc)
+    del doc.filters
+
+
+def main(doc=None):
+    index = None
+
+    def _prepare(doc):
+        nonlocal index
+        prepare(doc)
+        index = build_index(doc, doc.filters)
+
+    def stop_if(e):
+        # elements outside the index are still passed to action, which
+        # skips them, but their children are not walked
+        return index is not None and id(e) not in index
+
+    return runner.run_filter(action,
+                             prepare=_prepare,
+                             finalize=finalize,
+                             doc=doc,
+                             stop_if=stop_if,
+                             profile_elements=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""
+Thin pandoc filter forwarding the document to a running panflutist
+daemon (see panflutist_daemon.py).
+
+It only imports the standard library, so starting it is cheap. If no
+daemon is listening, it runs the panflutist driver in-process instead,
+so it can always be used in place of panflutist.py.
+
+Usage:
+
+- pandoc --filter=panflutist_client.py ...
+- The daemon's socket is taken from PANFLUTIST_SOCKET, or defaults to
+  panflutist.sock in $XDG_RUNTIME_DIR (or the panflutist cache
+  directory).
+"""
+
+import json
+import os
+import socket
+import sys
+
+
+def socket_path():
+    path = os.environ.get('PANFLUTIST_SOCKET')
+    if path:
+        return path
+    base = os.environ.get('XDG_RUNTIME_DIR')
+    if not base:
+        base = os.path.join(
+            os.environ.get('XDG_CACHE_HOME')
+            or os.path.join(os.path.expanduser('~'), '.cache'), 'panflutist')
+    return os.path.join(base, 'panflutist.sock')
+
+
+def connect():
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path())
+    except OSError:
+        client.close()
+        return None
+    return client
+
+
+def forward(client):
+    header = {'argv': sys.argv[1:], 'cwd': os.getcwd(), 'env': dict(os.environ)}
+    client.sendall(json.dumps(header).encode('utf-8') + b'\n')
+    client.sendall(sys.stdin.buffer.read())
+    client.shutdown(socket.SHUT_WR)
+
+    with client.makefile('rb') as response:
+        status = json.loads(response.readline())
+        sys.stderr.write(status.get('stderr', ''))
+        sys.stdout.buffer.write(response.read())
+    sys.stdout.buffer.flush()
+    return status.get('status', 1)
+
+
+def main():
+    client = connect()
+    if client is None:
+        import panflutist
+        return panflutist.main()
+    with client:
+        sys.exit(forward(client))
+
+
+if __name__ == '__main__':
+    main()
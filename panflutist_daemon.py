@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+Long-lived panflutist server for fast edit-compile loops.
+
+The daemon imports all filters and compiles all templates once, then
+listens on a Unix domain socket. Each request from panflutist_client.py
+is handled in a forked child that inherits this warm state, switches to
+the client's working directory and environment, runs the panflutist
+driver on the document and sends the result (and anything written to
+stderr) back. The children cache rendered blocks under the version of
+the code the daemon loaded, so editing the filters while it runs never
+mixes old output into the new code's cache entries; restart the daemon
+to use the edited code.
+
+Usage:
+
+- python panflutist_daemon.py [--socket PATH] &
+- pandoc --filter=panflutist_client.py ...
+"""
+
+import argparse
+import io
+import json
+import os
+import signal
+import socketserver
+import sys
+import ast_io
+import block_cache
+import jinja2tex
+import panflute as pf
+import panflutist
+import panflutist_client
+
+
+def warm_up():
+    for name in panflutist.FILTERS:
+        panflutist.Filter(name)
+    jinja2tex.compile_all()
+    # hashes the sources now, while they match the code just imported;
+    # forked children inherit the result
+    block_cache.code_version()
+
+
+def run(header, payload):
+    os.chdir(header['cwd'])
+    os.environ.clear()
+    os.environ.update(header['env'])
+    sys.argv = ['panflutist'] + header['argv']
+
+    doc = ast_io.loads(payload)
+    doc = panflutist.main(doc=doc)
+    return ast_io.dumps(doc)
+
+
+class Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        header = json.loads(self.rfile.readline())
+        payload = self.rfile.read()
+
+        stderr = sys.stderr
+        sys.stderr = io.StringIO()
+        try:
+            output = run(header, payload)
+            status = 0
+        except Exception as e:
+            output = b''
+            status = 1
+            pf.debug('panflutist daemon: {}: {}'.format(type(e).__name__, e))
+        finally:
+            messages = sys.stderr.getvalue()
+            sys.stderr = stderr
+
+        response = {'status': status, 'stderr': messages}
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+        self.wfile.write(output)
+
+
+class Server(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--socket', default=panflutist_client.socket_path())
+    options = parser.parse_args(argv)
+
+    warm_up()
+
+    directory = os.path.dirname(options.socket)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    if os.path.exists(options.socket):
+        os.unlink(options.socket)
+
+    umask = os.umask(0o077)
+    try:
+        server = Server(options.socket, Handler)
+    finally:
+        os.umask(umask)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        with server:
+            server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.unlink(options.socket)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+r"""
+Opt-in profiling of filter runs.
+
+When enabled, runner.run_filter times every call of a filter's action,
+prepare and finalize functions as well as every conversion.convert_text
+call. At the end of the run, call counts and cumulative/maximum times by
+filter, element type and span class, plus the slowest individual
+elements, are written as one line of JSON. Conversions are reported as
+filter `conversion`, with the route and formats as their kind (e.g.
+`deferred panflute->latex`).
+
+Usage:
+
+- Set PANFLUTIST_PROFILE to a file name to append reports to it, or to
+  `-` (or `1`) to write them to stderr. Alternatively, set it in the
+  document metadata:
+    ```yaml
+    profile: profile.jsonl
+    ```
+  `profile: true` writes to stderr.
+- PANFLUTIST_PROFILE_SLOWEST sets the number of slowest elements kept
+  (default: 20).
+"""
+
+import functools
+import heapq
+import itertools
+import json
+import os
+import sys
+import time
+import panflute as pf
+
+STDERR = ('-', '1', 'true', 'stderr')
+
+
+class Stat(object):
+
+    __slots__ = ['calls', 'seconds', 'max_seconds']
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+    def add(self, seconds):
+        self.calls += 1
+        self.seconds += seconds
+        if seconds > self.max_seconds:
+            self.max_seconds = seconds
+
+    def to_json(self):
+        return {
+            'calls': self.calls,
+            'seconds': self.seconds,
+            'max_seconds': self.max_seconds
+        }
+
+
+def element_classes(e):
+    return ' '.join(getattr(e, 'classes', None) or [])
+
+
+def element_label(e):
+    identifier = getattr(e, 'identifier', None)
+    if identifier:
+        return identifier
+    if isinstance(e, (pf.Inline, pf.Block)):
+        return pf.stringify(e)[:60]
+    return ''
+
+
+class Profiler(object):
+
+    __slots__ = ['target', 'keep', 'stats', 'slowest', 'counter', 'started']
+
+    def __init__(self, target, keep=20):
+        self.target = target
+        self.keep = keep
+        self.stats = {}
+        self.slowest = []
+        self.counter = itertools.count()
+        self.started = time.perf_counter()
+
+    def record(self, key, seconds):
+        stat = self.stats.get(key)
+        if stat is None:
+            stat = self.stats[key] = Stat()
+        stat.add(seconds)
+
+    def record_element(self, name, e, seconds):
+        classes = element_classes(e)
+        self.record((name, 'action', type(e).__name__, classes), seconds)
+        if len(self.slowest) < self.keep or seconds > self.slowest[0][0]:
+            entry = (seconds, next(self.counter), name, e)
+            if len(self.slowest) < self.keep:
+                heapq.heappush(self.slowest, entry)
+            else:
+                heapq.heapreplace(self.slowest, entry)
+
+    def wrap_action(self, name, action):
+
+        @functools.wraps(action)
+        def timed_action(e, doc, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return action(e, doc, *args, **kwargs)
+            finally:
+                self.record_element(name, e, time.perf_counter() - start)
+
+        return timed_action
+
+    def wrap(self, name, kind, function):
+
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record((name, kind, '', ''), time.perf_counter() - start)
+
+        return timed
+
+    def report(self, name):
+        stats = [
+            dict(filter=f, kind=kind, element=element, classes=classes,
+                 **stat.to_json())
+            for ((f, kind, element, classes), stat) in self.stats.items()
+        ]
+        stats.sort(key=lambda s: s['seconds'], reverse=True)
+        slowest = [{
+            'filter': f,
+            'seconds': seconds,
+            'element': type(e).__name__,
+            'classes': element_classes(e),
+            'identifier': element_label(e)
+        } for (seconds, _, f, e) in sorted(self.slowest, reverse=True)]
+        return {
+            'filter': name,
+            'pid': os.getpid(),
+            'seconds': time.perf_counter() - self.started,
+            'stats': stats,
+            'slowest': slowest
+        }
+
+    def write(self, name):
+        line = json.dumps(self.report(name), ensure_ascii=False)
+        if self.target in STDERR:
+            sys.stderr.write(line + '\n')
+            sys.stderr.flush()
+        else:
+            with open(self.target, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+
+
+def open_profiler(doc):
+    target = os.environ.get('PANFLUTIST_PROFILE')
+    if not target:
+        target = doc.get_metadata('profile', default=None)
+        if target is True:
+            target = 'stderr'
+    if not target:
+        return None
+    keep = int(os.environ.get('PANFLUTIST_PROFILE_SLOWEST', 20))
+    return Profiler(str(target), keep)
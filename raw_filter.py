@@ -0,0 +1,193 @@
+"""
+Filters on the decoded JSON instead of panflute objects.
+
+Filters that only replace a few elements (capital_spans,
+reference_spans, unnumbered_sections) otherwise pay for turning the
+whole AST into panflute objects and back. Here the document stays plain
+dicts and lists: a single pass finds the blocks and inlines matching
+the filter's HANDLES, only those are converted to panflute elements and
+passed to the unchanged action, and the JSON of the results replaces
+them in place. Everything else is written back as it was read. The
+metadata is small and is converted (and walked) as a whole, so prepare
+and finalize functions can use and change it as usual.
+
+Most nodes are leaves like {"t":"Str","c":"the"} or {"t":"Space"}.
+Equal leaves are decoded into a single shared dict (they are never
+changed in place; matches are replaced in their containers), which
+makes the decoded document a fraction of the size of either plain
+dicts or panflute objects.
+
+Matches are processed innermost first (as in panflute's walk), so
+nested matches are replaced before their ancestors are converted.
+During finalize, the results are the content of the (otherwise empty)
+document, so deferred conversions and highlighted listings are patched
+into them as usual; they are serialized again afterwards.
+
+Usage:
+
+- runner.run_filter(action, handles=HANDLES) when the document comes
+  from stdin. Only for actions that look at nothing but the element
+  itself and the metadata: the elements have no parents.
+"""
+
+import json
+import sys
+import ast_io
+import panflute as pf
+from panflute.elements import from_json
+
+# where the attributes are in the contents of elements that have them
+ATTRIBUTES = {'Header': 1}
+
+
+def shared_leaves():
+    """An object hook returning one dict for all equal leaves."""
+    leaves = {}
+
+    def hook(data):
+        content = data.get('c')
+        if 't' in data and (content is None or type(content) is str):
+            return leaves.setdefault((data['t'], content), data)
+        return data
+
+    return hook
+
+
+def loads(data):
+    return json.loads(data, object_hook=shared_leaves())
+
+
+def dumps(ast):
+    if ast_io.default_backend() == 'orjson':
+        return ast_io.orjson.dumps(ast)
+    return json.dumps(ast,
+                      check_circular=False,
+                      separators=(',', ':'),
+                      ensure_ascii=False).encode('utf-8')
+
+
+def load(stream=None):
+    if stream is None:
+        stream = sys.stdin.buffer
+    return loads(stream.read())
+
+
+def dump(ast, stream=None):
+    if stream is None:
+        stream = sys.stdout.buffer
+    stream.write(dumps(ast))
+    stream.flush()
+
+
+def to_element(data):
+    """panflute objects for decoded JSON, like pf.load's object hook."""
+    if isinstance(data, dict):
+        return from_json({key: to_element(value)
+                          for (key, value) in data.items()})
+    if isinstance(data, list):
+        return [to_element(value) for value in data]
+    return data
+
+
+def stub_document(ast, format=None):
+    """A Doc with the metadata of ast but no content."""
+    doc = pf.Doc(api_version=ast['pandoc-api-version'],
+                 metadata=to_element(ast['meta']))
+    if format is None:
+        format = sys.argv[1] if len(sys.argv) > 1 else 'html'
+    doc.format = format
+    return doc
+
+
+def find(ast, handled):
+    """
+    (container, key, node) for all nodes in the content of ast matching
+    handled (a dict from tag to a set of classes or None), in document
+    order.
+    """
+    found = []
+
+    def visit(container):
+        if type(container) is dict:
+            items = container.items()
+        else:
+            items = enumerate(container)
+        for (key, value) in items:
+            kind = type(value)
+            if kind is list:
+                visit(value)
+            elif kind is dict:
+                tag = value.get('t')
+                if tag is None:
+                    # citation
+                    visit(value)
+                    continue
+                if tag in handled:
+                    classes = handled[tag]
+                    if classes is None or not classes.isdisjoint(
+                            value['c'][ATTRIBUTES.get(tag, 0)][1]):
+                        found.append((container, key, value))
+                if type(value.get('c')) is list:
+                    visit(value['c'])
+
+    visit(ast['blocks'])
+    return found
+
+
+def stage(results):
+    """Blocks holding results, to make them the content of a document."""
+    blocks = []
+    for e in results:
+        if isinstance(e, pf.Block):
+            blocks.append(e)
+        elif isinstance(e, pf.Inline):
+            blocks.append(pf.Plain(e))
+    return blocks
+
+
+def run_filter(ast, doc, action, handles, prepare=None, finalize=None):
+    """
+    Apply action to the nodes of ast matching handles (a dict from type
+    to a set of classes or None, see runner.handled_classes).
+    """
+    handled = {kind.__name__: classes for (kind, classes) in handles.items()}
+    matches = find(ast, handled)
+    if prepare is not None:
+        prepare(doc)
+
+    def accepts(e):
+        classes = handles.get(type(e), False)
+        if classes is False:
+            return False
+        return classes is None or any(cls in classes for cls in e.classes)
+
+    doc.metadata = doc.metadata.walk(
+        lambda e, doc: action(e, doc) if accepts(e) else None, doc)
+
+    replaced = []
+    for (container, key, node) in reversed(matches):
+        element = to_element(node)
+        result = action(element, doc)
+        if result is None:
+            # keep changes the action made in place
+            result = element
+        results = result if isinstance(result, list) else [result]
+        nodes = [e.to_json() for e in results]
+        if isinstance(container, list):
+            container[key:key + 1] = nodes
+        elif nodes:
+            container[key] = nodes[0]
+        else:
+            del container[key]
+        replaced.extend(zip(nodes, results))
+
+    doc.content = stage(result for (_, result) in replaced)
+    if finalize is not None:
+        finalize(doc)
+    for (node, result) in replaced:
+        # the same dicts are still in place in ast
+        data = result.to_json()
+        node.clear()
+        node.update(data)
+    ast['meta'] = doc.metadata.content.to_json()
+    return ast
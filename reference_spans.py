@@ -10,10 +10,14 @@ Usage:
 
 from string import Template  # using .format() is hard because of {} in tex
 import panflute as pf
+import runner
 
 TEMPLATE_LSUPPER = Template(r'\autoref{$label}')
 
 
+HANDLES = [(pf.Span, 'ref')]
+
+
 def action(e, doc):
     if isinstance(e, pf.Span) and 'ref' in e.classes:
         label = pf.stringify(e).replace('#', '')
@@ -23,7 +27,7 @@ def action(e, doc):
 
 
 def main(doc=None):
-    return pf.run_filter(action, doc=doc)
+    return runner.run_filter(action, doc=doc, handles=HANDLES)
 
 
 if __name__ == '__main__':
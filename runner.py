@@ -0,0 +1,124 @@
+"""
+Common entry point for the filters in this repository.
+
+run_filter() wraps pf.run_filter and runs the shared per-document setup
+and teardown (e.g. resolving deferred conversions, see conversion.py)
+around a filter's own prepare/finalize functions. If profiling is
+enabled (see profiling.py), it also times all of them and writes the
+report once the document is finalized.
+
+When run as a pandoc filter, the document is read and written with
+ast_io.py. Filters that pass their HANDLES (see panflutist.py) skip
+panflute's walk instead: only the handled elements are converted to
+panflute objects and patched into the JSON (see raw_filter.py).
+"""
+
+import os
+import sys
+import ast_io
+import block_cache
+import conversion
+import panflute as pf
+import profiling
+import raw_filter
+
+
+def prepare_document(doc):
+    conversion.prepare(doc)
+    block_cache.prepare(doc)
+
+
+def finalize_document(doc):
+    conversion.resolve(doc)
+    block_cache.store(doc)
+    conversion.close(doc)
+
+
+def handled_classes(handles):
+    """
+    HANDLES as a dict from element type to a set of classes, or to None
+    for all elements of the type.
+    """
+    handled = {}
+    for (kind, cls) in handles:
+        classes = handled.setdefault(kind, set())
+        if cls is None or classes is None:
+            handled[kind] = None
+        else:
+            classes.add(cls)
+    return handled
+
+
+def filter_name(action, kwargs):
+    # yaml_filter based filters are named after their tag functions
+    function = kwargs.get('function') or next(
+        iter((kwargs.get('tags') or {}).values()), action)
+    name = getattr(function, '__module__', None)
+    if name in (None, '__main__'):
+        name = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    return name
+
+
+def run_filter(action,
+               prepare=None,
+               finalize=None,
+               doc=None,
+               handles=None,
+               profile_elements=True,
+               **kwargs):
+    """
+    Like pf.run_filter. profile_elements=False leaves the action
+    untimed, for drivers whose sub-filters time their own actions.
+    """
+    load_and_dump = doc is None
+    ast = None
+    if load_and_dump and handles is not None:
+        ast = raw_filter.load()
+        doc = raw_filter.stub_document(ast)
+    elif load_and_dump:
+        doc = ast_io.load()
+
+    profiler = profiling.open_profiler(doc)
+    doc.profiler = profiler
+    finalize_conversions = finalize_document
+    if profiler is not None:
+        name = filter_name(action, kwargs)
+        if profile_elements:
+            action = profiler.wrap_action(name, action)
+        if prepare is not None:
+            prepare = profiler.wrap(name, 'prepare', prepare)
+        if finalize is not None:
+            finalize = profiler.wrap(name, 'finalize', finalize)
+        finalize_conversions = profiler.wrap('conversion', 'finalize',
+                                             finalize_document)
+
+    def _prepare(doc):
+        prepare_document(doc)
+        if prepare is not None:
+            prepare(doc)
+
+    def _finalize(doc):
+        if finalize is not None:
+            finalize(doc)
+        finalize_conversions(doc)
+
+    if ast is not None:
+        raw_filter.run_filter(ast, doc, action, handled_classes(handles),
+                              _prepare, _finalize)
+    else:
+        doc = pf.run_filter(action,
+                            prepare=_prepare,
+                            finalize=_finalize,
+                            doc=doc,
+                            **kwargs)
+
+    if profiler is not None:
+        profiler.write(name)
+        doc.profiler = None
+
+    if ast is not None:
+        raw_filter.dump(ast)
+    elif load_and_dump:
+        ast_io.dump(doc)
+    else:
+        return doc
@@ -0,0 +1,19 @@
+"""
+In-process application of the stateless inline span filters to nested
+content.
+
+Filters that convert whole subtrees (table captions, unnumbered
+headings) run walk() on the content first, so e.g. [tbl:a]{.ref} spans
+inside it are resolved without spawning a nested pandoc --filter.
+"""
+
+import capital_spans
+import reference_spans
+
+ACTIONS = [capital_spans.action, reference_spans.action]
+
+
+def walk(elem, doc):
+    for action in ACTIONS:
+        elem = elem.walk(action, doc)
+    return elem
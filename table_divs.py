@@ -22,13 +22,44 @@ Usage:
     Table: This is the table caption. Suspendisse blandit dolor sed tellus venenatis, venenatis fringilla turpis pretium.
     :::
     ```
+- Large tables can be read from a CSV file instead; the Div then only
+  holds the caption:
+    ```markdown
+    ::: {.divtable #tbl:data source="data.csv" widths="0.2 0.4 0.4" align="lrr"}
+    This is the table caption.
+    :::
+    ```
+  The first row is the header; `delimiter` sets the CSV delimiter. Rows
+  are streamed from the file into a longtable in a side file (in
+  `asset-dir`, see assets.py) that is \input and only rewritten when the
+  CSV file or the Div changes. Cells are escaped in-process; only cells
+  using Markdown are converted by pandoc, a chunk of rows at a time.
+- Columns with a width become p{} columns, so only header cells (which
+  are bottom-aligned) need a minipage. Add
+  \usepackage{array,booktabs,longtable} to the preamble.
+- Tables estimated to fit on a page are set as a tabular in a table
+  float; longer ones as a longtable. Force either with long="true" or
+  long="false" on the Div.
+- Tables with more than one header row or with cells spanning rows or
+  columns are left to pandoc's LaTeX writer.
 
 """
 
 from decimal import Decimal
 from enum import Enum
-from jinja2tex import latex_env
+from jinja2tex import template
+import assets
+import block_cache
+import conversion
+import csv
+import hashlib
+import json
+import latex_writer
+import os
 import panflute as pf
+import re
+import runner
+import span_filters
 
 
 class VerticalAlignment(Enum):
@@ -55,71 +86,144 @@ class LatexTableCell(object):
         'AlignDefault': r'\raggedright',
         'AlignLeft': r'\raggedright',
         'AlignRight': r'\raggedleft',
-        #'AlignCenter': r'\centered'
-        'AlignCenter': r''
+        'AlignCenter': r'\centering'
     }
 
-    __slots__ = ['content', 'width', 'align', 'valign']
+    __slots__ = ['content', 'width', 'align', 'valign', 'minipage']
 
     def __init__(self,
                  content,
                  width,
+                 doc,
                  scale=1.0,
                  align=Alignment.DEFAULT,
                  valign=VerticalAlignment.TOP):
-        self.content = pf.convert_text(content,
-                                       extra_args=['--biblatex'],
-                                       input_format='panflute',
-                                       output_format='latex')
-        self.width = scale * width
+        self.content = conversion.convert_text(content,
+                                               doc,
+                                               extra_args=['--biblatex'],
+                                               input_format='panflute',
+                                               output_format='latex')
+        self.width = format_width(scale * width)
         self.align = self.LATEX_ALIGNMENT[align]
         self.valign = valign.value
+        # p{} columns are top-aligned already
+        self.minipage = needs_minipage(scale * width, valign)
+
+
+def format_width(width):
+    return '{:.4g}'.format(width)
+
+
+def needs_minipage(width, valign):
+    return width > 0 and valign != VerticalAlignment.TOP
+
+
+def column_width(width):
+    """Width of a colspec entry; 0 for columns without a width."""
+    return 0.0 if width == 'ColWidthDefault' else float(width)
+
+
+def caption_inlines(caption):
+    return [
+        inline for block in caption.content
+        if isinstance(block, (pf.Plain, pf.Para)) for inline in block.content
+    ]
+
+
+def column_spec(widths, alignment):
+    """p{} columns for columns with a width, l/r/c for the others."""
+    spec = []
+    for (width, align) in zip(widths, alignment):
+        if width > 0:
+            spec.append(r'>{{{}\arraybackslash}}p{{{}\columnwidth}}'.format(
+                LatexTableCell.LATEX_ALIGNMENT[align], format_width(width)))
+        else:
+            spec.append(LatexTable.TABULAR_ALIGNMENT[align])
+    return ''.join(spec)
 
 
 class LatexTableRow(object):
-    ROW_TMPL = latex_env.from_string(r"""
+    ROW_TMPL = template(r"""
 """)
 
     __slots__ = ['cells']
 
-    def __init__(self, row, scale, valign, parent):
+    def __init__(self, row, scale, valign, parent, doc):
         self.cells = [
-            LatexTableCell(cell.content, parent.width[i], scale,
-                           parent.alignment[i], valign)
+            LatexTableCell(
+                cell.content, parent.widths[i], doc, scale,
+                cell.alignment if cell.alignment != 'AlignDefault' else
+                parent.alignment[i], valign)
             for (i, cell) in enumerate(row.content)
         ]
 
 
 class LatexTable(object):
-    TABLE_TMPL = latex_env.from_string(r"""<% macro make_row(row) -%>
-<%- for cell in row.cells -%>
+    TABLE_TMPL = template(r"""<% macro make_cell(cell) -%>
+<%- if cell.minipage -%>
 \begin{minipage}[<< cell.valign >>]{<< cell.width >>\columnwidth}<< cell.align >>
 << cell.content >>\strut
-\end{minipage}<% if not loop.last %> & <% else %>\tabularnewline<% endif %>
+\end{minipage}
+<%- else -%>
+<< cell.content >>\strut
+<%- endif -%>
+<%- endmacro -%>
+<% macro make_row(row) -%>
+<%- for cell in row.cells -%>
+<< make_cell(cell) >><% if not loop.last %> & <% else %>\tabularnewline<% endif %>
 <% endfor -%>
-<%- endmacro %>
+<%- endmacro -%>
+<% if not table.long -%>
+\begin{table}<% if table.placement %>[<< table.placement >>]<% endif %>
+\centering
+\begin{tabular}{@{}<< table.col_descriptor >>@{}}
+\toprule
+<% if table.header -%>
+<< make_row(table.header) ->>
+\midrule
+<% endif -%>
+<% for row in table.rows -%>
+<< make_row(row) >>
+<%- endfor -%>
+\bottomrule
+\end{tabular}
+\caption<% if table.short_caption %>[<< table.short_caption >>]<% endif %>{<< table.caption >>}
+<%- if table.identifier %>\label{<< table.identifier >>}<% endif %>
+\end{table}
+<%- else -%>
 \begin{longtable}<% if table.placement %>[<< table.placement >>]<% endif %>{@{}<< table.col_descriptor >>@{}}
 \caption<% if table.short_caption %>[<< table.short_caption >>]<% endif %>{<< table.caption >>}
 <%- if table.identifier %>\label{<< table.identifier >>}<% endif -%>\endlastfoot
 \toprule
+<% if table.header -%>
 << make_row(table.header) ->>
 \midrule
+<% endif -%>
 \endfirsthead
 \toprule
+<% if table.header -%>
 << make_row(table.header) ->>
 \midrule
+<% endif -%>
 \endhead
 <% for row in table.rows -%>
 << make_row(row) >>
 <%- endfor -%>
 \bottomrule
-\end{longtable}""")
+\end{longtable}
+<%- endif %>""")
 
     __slots__ = [
         'table', 'scale', 'header', 'caption', 'identifier', 'short_caption',
-        'placement', 'col_descriptor', 'rows'
+        'placement', 'col_descriptor', 'rows', 'long', 'widths', 'alignment'
     ]
 
+    # tables estimated to take more lines than this become longtables
+    SHORT_LINES = 30
+
+    # characters per line of a cell as wide as the column width
+    CHARACTERS_PER_LINE = 80
+
     TABULAR_ALIGNMENT = {
         'AlignDefault': r'l',
         'AlignLeft': r'l',
@@ -127,50 +231,305 @@ class LatexTable(object):
         'AlignCenter': r'c'
     }
 
-    def __init__(self, table):
+    def __init__(self, table, doc):
         self.table = table
         self.scale = float(table.parent.attributes.get('width', 1))
         self.short_caption = table.parent.attributes.get('short')
         self.placement = table.parent.attributes.get('placement')
-        self.col_descriptor = ''.join(
-            [self.TABULAR_ALIGNMENT[a] for a in table.alignment])
-
-        self.caption = pf.convert_text(
-            pf.Plain(*table.caption),
-            extra_args=[
-                '--biblatex', '--filter=tools/panflutist/reference_spans.py'
-            ],
+        self.alignment = [align for (align, _) in table.colspec]
+        self.widths = [column_width(width) for (_, width) in table.colspec]
+        self.col_descriptor = column_spec(
+            [self.scale * w for w in self.widths], self.alignment)
+
+        (header, rows) = self.table_rows(table)
+        self.long = self.is_long(table, header, rows)
+
+        self.caption = conversion.convert_text(
+            span_filters.walk(pf.Plain(*caption_inlines(table.caption)),
+                              doc),
+            doc,
+            extra_args=['--biblatex'],
             input_format='panflute',
             output_format='latex')
         self.identifier = table.parent.identifier
 
-        self.header = LatexTableRow(table.header, self.scale,
-                                    VerticalAlignment.BOTTOM, table)
+        self.header = None
+        if header is not None:
+            self.header = LatexTableRow(header, self.scale,
+                                        VerticalAlignment.BOTTOM, self, doc)
         self.rows = [
-            LatexTableRow(row, self.scale, VerticalAlignment.TOP, table)
-            for row in table.content
+            LatexTableRow(row, self.scale, VerticalAlignment.TOP, self, doc)
+            for row in rows
         ]
 
+    @staticmethod
+    def table_rows(table):
+        """The header row (or None) and the other rows of a table."""
+        head = list(table.head.content) if table.head is not None else []
+        rows = []
+        for body in table.content:
+            rows.extend(body.head)
+            rows.extend(body.content)
+        if table.foot is not None:
+            rows.extend(table.foot.content)
+        return (head[0] if head else None, rows)
+
+    @staticmethod
+    def unsupported(table):
+        """Why the table cannot be set by this filter, or None."""
+        head = table.head.content if table.head is not None else []
+        if len(head) > 1:
+            return 'more than one header row'
+        (header, rows) = LatexTable.table_rows(table)
+        for row in ([header] if header is not None else []) + rows:
+            if any(cell.rowspan != 1 or cell.colspan != 1
+                   for cell in row.content):
+                return 'cells spanning rows or columns'
+        return None
+
+    def is_long(self, table, header, rows):
+        forced = table.parent.attributes.get('long')
+        if forced is not None:
+            return forced.lower() == 'true'
+
+        # columns without a width get an even share of the text width
+        widths = [width or 1 / len(self.widths) for width in self.widths]
+        lines = 0
+        for row in ([header] if header is not None else []) + rows:
+            lines += max([1] + [
+                -(-len(pf.stringify(cell)) // max(
+                    1, int(self.scale * width * self.CHARACTERS_PER_LINE)))
+                for (cell, width) in zip(row.content, widths)
+            ])
+            if lines > self.SHORT_LINES:
+                return True
+        return False
+
     def render(self):
         return self.TABLE_TMPL.render(table=self)
 
     @staticmethod
-    def parse_table(table):
+    def parse_table(table, doc):
         if isinstance(table.parent,
                       pf.Div) and 'divtable' in table.parent.classes:
-            return LatexTable(table)
+            reason = LatexTable.unsupported(table)
+            if reason is not None:
+                pf.debug('table_divs: leaving table {} to pandoc: {}'.format(
+                    table.parent.identifier, reason))
+                return None
+            return LatexTable(table, doc)
+
+
+class StreamedTableCell(object):
+    """A cell with content that is LaTeX already."""
 
+    __slots__ = ['content', 'width', 'align', 'valign', 'minipage']
 
+    def __init__(self, content, width, align, valign):
+        self.content = content
+        self.width = format_width(width)
+        self.align = LatexTableCell.LATEX_ALIGNMENT[align]
+        self.valign = valign.value
+        self.minipage = needs_minipage(width, valign)
+
+
+class StreamedTableRow(object):
+
+    __slots__ = ['cells']
+
+    def __init__(self, cells):
+        self.cells = cells
+
+
+class CsvTable(object):
+    """A divtable whose rows are streamed from a CSV file."""
+
+    ALIGNMENT = {'l': 'AlignLeft', 'r': 'AlignRight', 'c': 'AlignCenter'}
+
+    # cells pandoc would only escape: no Markdown syntax (underscores only
+    # within words), no list markers and nothing the smart extension
+    # turns into quotes, dashes, ellipses or non-breaking spaces. Spaces
+    # are fine in themselves; NOT_PLAIN_CELL catches the sequences of
+    # them that are not
+    PLAIN_CELL = re.compile(r'^(?![-+*#>|:]|\(?\w+[.)](\s|$))'
+                            r'[^*`\[\]^~\\<>$@|\'"\n\t\u00a0]*$')
+    NOT_PLAIN_CELL = re.compile(r'(?<!\w)_|_(?!\w)|--|\.\.\.|\.\s|  ')
+
+    # rows converted (and held in memory) at a time
+    CHUNK = 256
+
+    __slots__ = [
+        'div', 'doc', 'path', 'delimiter', 'scale', 'header', 'caption',
+        'identifier', 'short_caption', 'placement', 'col_descriptor', 'rows',
+        'widths', 'alignment', 'long'
+    ]
+
+    def __init__(self, div, doc):
+        self.div = div
+        self.doc = doc
+        self.path = div.attributes['source']
+        self.delimiter = div.attributes.get('delimiter', ',')
+        self.scale = float(div.attributes.get('width', 1))
+        self.placement = div.attributes.get('placement')
+        self.identifier = div.identifier
+        # rows are streamed, so their number is not known up front
+        self.long = True
+
+    def output_path(self):
+        """Side file for the rendered table, named after its inputs."""
+        info = os.stat(self.path)
+        data = [
+            'csvtable',
+            block_cache.code_version(),
+            os.path.abspath(self.path), info.st_mtime_ns, info.st_size,
+            self.div.to_json()
+        ]
+        cache = getattr(self.doc, 'fragment_cache', None)
+        if cache is not None:
+            name = cache.block_key(data)
+        else:
+            name = hashlib.sha256(
+                json.dumps(data).encode('utf-8')).hexdigest()
+        directory = self.doc.get_metadata('asset-dir',
+                                          default=assets.DEFAULT_DIRECTORY)
+        return os.path.join(directory, name + '.tex')
+
+    def convert(self, texts, input_format='markdown'):
+        return conversion.convert_many(texts,
+                                       self.doc,
+                                       input_format=input_format,
+                                       extra_args=['--biblatex'])
+
+    def convert_cells(self, texts):
+        texts = [text.strip() for text in texts]
+        markdown = [
+            text for text in texts if not self.PLAIN_CELL.match(text)
+            or self.NOT_PLAIN_CELL.search(text)
+        ]
+        converted = iter(self.convert(markdown))
+        return [
+            next(converted) if not self.PLAIN_CELL.match(text)
+            or self.NOT_PLAIN_CELL.search(text) else latex_writer.escape(text)
+            for text in texts
+        ]
+
+    def prepare_columns(self, header):
+        count = len(header)
+        if count == 0:
+            raise ValueError('{}: no header row'.format(self.path))
+        widths = self.div.attributes.get('widths')
+        if widths:
+            widths = [float(w) for w in widths.replace(',', ' ').split()]
+            if len(widths) != count:
+                raise ValueError('{} widths for {} columns'.format(
+                    len(widths), count))
+        else:
+            widths = [1.0 / count] * count
+        self.widths = [self.scale * w for w in widths]
+        align = self.div.attributes.get('align', '')
+        self.alignment = [
+            self.ALIGNMENT.get(align[i:i + 1], 'AlignDefault')
+            for i in range(count)
+        ]
+        self.col_descriptor = column_spec(self.widths, self.alignment)
+
+    def convert_rows(self, rows, valign):
+        count = len(self.widths)
+        rows = [(row + [''] * count)[:count] for row in rows]
+        converted = iter(
+            self.convert_cells([text for row in rows for text in row]))
+        return [
+            StreamedTableRow([
+                StreamedTableCell(next(converted), self.widths[i],
+                                  self.alignment[i], valign)
+                for i in range(count)
+            ]) for _ in rows
+        ]
+
+    def stream(self, reader):
+        chunk = []
+        for row in reader:
+            chunk.append(row)
+            if len(chunk) == self.CHUNK:
+                yield from self.convert_rows(chunk, VerticalAlignment.TOP)
+                chunk = []
+        if chunk:
+            yield from self.convert_rows(chunk, VerticalAlignment.TOP)
+
+    def prepare_captions(self):
+        blocks = [
+            block for block in self.div.content
+            if isinstance(block, (pf.Para, pf.Plain))
+        ]
+        caption = pf.Plain(*blocks[0].content) if blocks else pf.Plain()
+        self.caption = self.convert([span_filters.walk(caption, self.doc)],
+                                    input_format='panflute')[0]
+        self.short_caption = self.div.attributes.get('short')
+        if self.short_caption:
+            self.short_caption = self.convert([self.short_caption])[0]
+
+    def write(self, path):
+        self.prepare_captions()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temporary = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(self.path, newline='', encoding='utf-8') as source, \
+                    open(temporary, 'w', encoding='utf-8') as output:
+                reader = csv.reader(source, delimiter=self.delimiter)
+                header = next(reader, [])
+                self.prepare_columns(header)
+                self.header = self.convert_rows([header],
+                                                VerticalAlignment.BOTTOM)[0]
+                self.rows = self.stream(reader)
+                for chunk in LatexTable.TABLE_TMPL.generate(table=self):
+                    output.write(chunk)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        os.replace(temporary, path)
+
+    def render(self):
+        path = self.output_path()
+        if not os.path.exists(path):
+            self.write(path)
+        return r'\input{{{}}}'.format(path.replace(os.sep, '/'))
+
+
+HANDLES = [(pf.Table, None), (pf.Div, 'divtable')]
+
+
+def is_csv_table(e):
+    return isinstance(e, pf.Div) and 'divtable' in e.classes and \
+        'source' in e.attributes
+
+
+@block_cache.cached_action(
+    'table_divs', lambda e, doc: isinstance(e, pf.Table) and isinstance(
+        e.parent, pf.Div) and 'divtable' in e.parent.classes and doc.format ==
+    'latex')
 def action(pandoc_table, doc):
+    if is_csv_table(pandoc_table) and doc.format == 'latex':
+        try:
+            return pf.RawBlock(CsvTable(pandoc_table, doc).render(),
+                               format='latex')
+        except (OSError, ValueError, csv.Error) as e:
+            pf.debug('table_divs: leaving table {} unchanged: {}'.format(
+                pandoc_table.identifier, e))
+            return pandoc_table
     if not isinstance(pandoc_table, pf.Table) or not doc.format == 'latex':
         return pandoc_table
 
-    table = LatexTable.parse_table(pandoc_table)
+    table = LatexTable.parse_table(pandoc_table, doc)
+    if table is None:
+        return pandoc_table
     return pf.RawBlock(table.render(), format='latex')
 
 
 def main(doc=None):
-    return pf.run_filter(action, doc=doc)
+    return runner.run_filter(action, doc=doc)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,10 @@
+import os
+import shutil
+import sys
+import pytest
+
+# the filters are flat modules in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+needs_pandoc = pytest.mark.skipif(shutil.which('pandoc') is None,
+                                  reason='pandoc is not installed')
@@ -0,0 +1,39 @@
+import panflute as pf
+import panflutist
+from conftest import needs_pandoc
+
+DOCUMENT = """---
+deferred-conversion: true
+---
+
+::: {{.divtable #tbl:a}}
++---------------------------------------------+--------+
+| Figure                                      | Note   |
++=============================================+========+
+| ![A [linked](http://x.org) caption](a.pdf)  | *one*  |
++---------------------------------------------+--------+
+
+Table: The [table](http://t.org) caption with {}.
+:::
+"""
+
+
+def build(markdown):
+    doc = pf.convert_text(markdown, standalone=True)
+    doc.format = 'latex'
+    doc = panflutist.main(doc=doc)
+    return pf.convert_text(doc,
+                           input_format='panflute',
+                           output_format='latex')
+
+
+@needs_pandoc
+def test_nested_results_are_stored_resolved(tmp_path, monkeypatch):
+    # the figure is cached on its own but only patched inside the table
+    monkeypatch.setenv('PANFLUTIST_CACHE', str(tmp_path / 'cache.sqlite'))
+    build(DOCUMENT.format('y'))
+    tex = build(DOCUMENT.format('z'))
+    figure = tex[tex.index(r'\includegraphics'):].splitlines()
+    assert figure[1] == r'\caption{A \href{http://x.org}{linked} caption}'
+    assert tex.count('caption with z.') == 1
+    assert 'PANFLUTISTFRAGMENT' not in tex
@@ -0,0 +1,21 @@
+import build
+
+
+def chapter(path, *definitions):
+    return (path, list(definitions), None, 0.0)
+
+
+def test_merge_keeps_the_last_definition_like_glossary_spans():
+    merged = build.merge_definitions([
+        chapter('a.md', ('gl', 'x', 'X', 'one'), ('ac', 'so', 'SO', 'so')),
+        chapter('b.md', ('gl', 'x', 'X', 'two')),
+    ])
+    assert merged == [('x', 'X', 'two'), ('so', 'SO', 'so')]
+
+
+def test_merge_drops_a_label_redefined_as_the_other_kind():
+    merged = build.merge_definitions([
+        chapter('a.md', ('ac', 'dup', 'D', 'abbreviation')),
+        chapter('b.md', ('gl', 'dup', 'Dup', 'entry')),
+    ])
+    assert merged == [('dup', 'D', 'abbreviation')]
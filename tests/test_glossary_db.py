@@ -0,0 +1,39 @@
+import pytest
+import glossary_db
+import glossary_spans
+
+pytest.importorskip('yaml')
+
+
+def test_malformed_yaml_is_skipped(tmp_path):
+    source = tmp_path / 'glossary.yaml'
+    source.write_text('ptt: [unclosed\n', encoding='utf-8')
+    assert glossary_db.read_entries(str(source)) == []
+    source.write_text('- a\n- b\n', encoding='utf-8')
+    assert glossary_db.read_entries(str(source)) == []
+
+
+def test_entries_that_are_not_mappings_are_skipped(tmp_path):
+    source = tmp_path / 'glossary.yaml'
+    source.write_text('so:\n  short: SO\n  long: Stack Overflow\n'
+                      'bad: just a string\n',
+                      encoding='utf-8')
+    assert [entry['label'] for entry in glossary_db.read_entries(str(source))
+            ] == ['so']
+
+
+def test_database_entry_matches_its_span_definition(monkeypatch):
+    warnings = []
+    monkeypatch.setattr(glossary_spans.pf, 'debug',
+                        lambda *args: warnings.append(args))
+    entries = {}
+    glossary_spans.define(entries, 'ptt', {
+        'label': 'ptt', 'name': 'Potato', 'source': 'Starchy *tuber*',
+        'description': r'Starchy \emph{tuber}', 'text': None,
+        'plural': None, 'sort': None
+    })
+    glossary_spans.define(entries, 'ptt', {
+        'label': 'ptt', 'name': 'Potato', 'source': 'Starchy *tuber*',
+        'text': None, 'plural': None, 'sort': None
+    })
+    assert warnings == []
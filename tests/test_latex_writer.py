@@ -0,0 +1,58 @@
+import panflute as pf
+import pytest
+import latex_writer
+from conftest import needs_pandoc
+
+SAMPLES = [
+    'a & b % c $ d # e _ f { g } h ~ i ^ j \\ k | l [m] n',
+    '"quoted" and *emph* **strong** `co{d}e` [sc]{.smallcaps}',
+    '"a \'nested\' quote" \'single\' it\'s',
+    '`a--b` `it\'s` `a b` `x~y` `q\\b`',
+    'a -- b --- c ... d a-\\-b? `x` !',
+    'Erträge *von* Food-Trucks [vgl. @Perez_PythonEcosystem_2011, 13]',
+    '@Foo [12] and [-@Foo, 1--3] [@A; @B] [@A, 12; vgl. @B, 3]',
+    'Ganz Gallien ist von den Römern besetzt',
+    'Starchy tuber, 3 kinds (roughly)',
+    'Raw \\textit{tex} and ~~struck~~',
+    '[@Foo, S. 13]',
+    'Mr. Smith, Dr. No and Prof. Miller',
+    'see p. 5 and pp. 3, 4, cf. Smith',
+    'Who?\\` and why!\\` or what?‘x’',
+    "it's 'single' and rock 'n' roll, x' ?' '`a",
+]
+
+# without the smart extension, apostrophes stay ASCII ' in Str elements
+READERS = ['markdown', 'markdown-smart']
+
+
+def pandoc(sample, reader):
+    # pandoc breaks long lines at spaces, which LaTeX does not distinguish
+    # from spaces; everything else must match exactly
+    return pf.convert_text(sample,
+                           extra_args=['--biblatex', '--wrap=none'],
+                           input_format=reader,
+                           output_format='latex')
+
+
+@needs_pandoc
+@pytest.mark.parametrize('sample', SAMPLES)
+def test_markdown_matches_pandoc(sample):
+    ours = latex_writer.write(sample, 'markdown', ['--biblatex'])
+    if ours is not None:
+        assert ours == pandoc(sample, 'markdown')
+
+
+@needs_pandoc
+@pytest.mark.parametrize('reader', READERS)
+@pytest.mark.parametrize('sample', SAMPLES)
+def test_panflute_matches_pandoc(sample, reader):
+    fragment = pf.convert_text(sample, input_format=reader)
+    ours = latex_writer.write(fragment, 'panflute', ['--biblatex'])
+    if ours is not None:
+        assert ours == pandoc(sample, reader)
+
+
+def test_unsupported_elements_need_pandoc():
+    assert latex_writer.write([pf.Para(pf.Link(pf.Str('x'), url='y'))]) \
+        is None
+    assert latex_writer.write('a_b', 'markdown') is None
@@ -0,0 +1,56 @@
+import panflute as pf
+import pytest
+import latex_writer
+import table_divs
+from conftest import needs_pandoc
+
+PIPE_TABLE = """::: {.divtable #tbl:short}
+| Header | Values |
+|--------|--------|
+""" + ''.join('| row{}   | {}      |\n'.format(i, i) for i in range(7)) + """
+Table: A short table.
+:::
+"""
+
+
+def render(markdown):
+    doc = pf.convert_text(markdown, standalone=True)
+    doc.format = 'latex'
+    doc = table_divs.main(doc=doc)
+    return pf.convert_text(doc,
+                           input_format='panflute',
+                           output_format='latex')
+
+
+@needs_pandoc
+def test_short_table_without_widths_is_a_float(tmp_path, monkeypatch):
+    monkeypatch.setenv('PANFLUTIST_CACHE', str(tmp_path / 'cache.sqlite'))
+    tex = render(PIPE_TABLE)
+    assert r'\begin{table}' in tex
+    assert 'longtable' not in tex
+
+
+CELLS = [
+    'Row 1', 'Food trucks & co', '0,5 %', 'a = b + c', 'x_y and z',
+    'Mr. Smith', 'p. 5', '1. item', 'A) item', 'a -- b', 'wait...',
+    'two  spaces', '_emph_ here', 'Ende gut, alles gut!', '(a) b'
+]
+
+
+@needs_pandoc
+@pytest.mark.parametrize('text', CELLS)
+def test_plain_cells_are_escaped_like_pandoc(text):
+    plain = table_divs.CsvTable.PLAIN_CELL.match(text) and \
+        not table_divs.CsvTable.NOT_PLAIN_CELL.search(text)
+    if plain:
+        assert latex_writer.escape(text) == pf.convert_text(
+            text, output_format='latex', extra_args=['--wrap=none'])
+
+
+def test_cells_with_spaces_can_be_plain():
+    for text in ['Row 1', 'see p. 5', 'two  spaces']:
+        assert table_divs.CsvTable.PLAIN_CELL.match(text)
+    assert not table_divs.CsvTable.NOT_PLAIN_CELL.search('Row 1')
+    # the spaces pandoc's smart extension cares about
+    assert table_divs.CsvTable.NOT_PLAIN_CELL.search('see p. 5')
+    assert table_divs.CsvTable.NOT_PLAIN_CELL.search('two  spaces')
@@ -13,10 +13,12 @@ Usage:
 - This filter will emit \{textquote/foreigntextquote}[<cite>][<punct>]{<text>} commands
 """
 
-from jinja2tex import latex_env
+from jinja2tex import template
+import conversion
 import panflute as pf
+import runner
 
-QUOTE = latex_env.from_string(r"""
+QUOTE = template(r"""
 <%- if lang %>\foreigntextquote{<< lang >>}<% else %>\textquote<% endif -%>
 <% if cite %>[{<< cite >>}]<% endif -%>
 <% if punct %>[<< punct >>]<% endif -%>
@@ -27,6 +29,9 @@ def prepare(doc):
     pass
 
 
+HANDLES = [(pf.Span, 'textquote')]
+
+
 def action(e, doc):
     if not doc.format == 'latex':
         return None
@@ -34,14 +39,16 @@ def action(e, doc):
     if isinstance(e, pf.Span) and 'textquote' in e.classes:
         cite = e.attributes.get('cite')
         if cite:
-            cite = pf.convert_text(cite,
-                                   extra_args=['--biblatex'],
-                                   input_format='markdown',
-                                   output_format='latex')
-        text = pf.convert_text(pf.Plain(e),
-                               extra_args=['--biblatex'],
-                               input_format='panflute',
-                               output_format='latex')
+            cite = conversion.convert_text(cite,
+                                           doc,
+                                           extra_args=['--biblatex'],
+                                           input_format='markdown',
+                                           output_format='latex')
+        text = conversion.convert_text(pf.Plain(e),
+                                       doc,
+                                       extra_args=['--biblatex'],
+                                       input_format='panflute',
+                                       output_format='latex')
         values = {
             'lang': e.attributes.get('lang'),
             'cite': cite,
@@ -60,7 +67,10 @@ def finalize(doc):
 
 
 def main(doc=None):
-    return pf.run_filter(action, prepare=prepare, finalize=finalize, doc=doc)
+    return runner.run_filter(action,
+                             prepare=prepare,
+                             finalize=finalize,
+                             doc=doc)
 
 
 if __name__ == '__main__':
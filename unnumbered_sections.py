@@ -10,22 +10,32 @@ Usage:
 
 """
 
-from jinja2tex import latex_env
+from jinja2tex import template
+import block_cache
+import conversion
 import panflute as pf
+import runner
+import span_filters
 
-SECTION = latex_env.from_string(r'\addsec{<< text >>}')
-CHAPTER = latex_env.from_string(r'\addchap{<< text >>}')
+SECTION = template(r'\addsec{<< text >>}')
+CHAPTER = template(r'\addchap{<< text >>}')
 
 
+HANDLES = [(pf.Header, 'unnumbered')]
+
+
+@block_cache.cached_action(
+    'unnumbered_sections',
+    lambda e, doc: isinstance(e, pf.Header) and 'unnumbered' in e.classes and
+    doc.format == 'latex',
+    metadata=['use-chapter'])
 def action(e, doc):
     if isinstance(e, pf.Header) and 'unnumbered' in e.classes:
         if doc.format == 'latex':
-            text = pf.convert_text(
-                pf.Plain(*e.content),
-                extra_args=[
-                    '--biblatex',
-                    '--filter=tools/panflutist/reference_spans.py'
-                ],
+            text = conversion.convert_text(
+                span_filters.walk(pf.Plain(*e.content), doc),
+                doc,
+                extra_args=['--biblatex'],
                 input_format='panflute',
                 output_format='latex')
 
@@ -36,7 +46,7 @@ def action(e, doc):
 
 
 def main(doc=None):
-    return pf.run_filter(action, doc=doc)
+    return runner.run_filter(action, doc=doc, handles=HANDLES)
 
 
 if __name__ == '__main__':